@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Benchmarks ModbusScanner against a fleet of simulated PLCs on this machine.
+# Each simulated device listens on its own loopback address (127.1.x.y) on a shared port, so the
+# scanner sweeps and probes them exactly like a real subnet. Latency, jitter and exception responses
+# are injected by the simulator. Results are printed and saved as JSON for comparison across commits.
+#
+#   python Benchmarks/fleet_benchmark.py --devices 50 --latency-ms 5 --jitter-ms 2
+#   python Benchmarks/fleet_benchmark.py --compare Benchmarks/results/<earlier run>.json
+import argparse
+import asyncio
+import ipaddress
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import subprocess
+import sys
+import time
+
+FRAMEWORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FRAMEWORK_DIR)
+
+import PLCFramework  # noqa: E402
+
+DEVICE_INFORMATION = {0: b'SimulatedPLC', 1: b'BENCH', 2: b'1.0'}
+
+
+class SimulatedDevice:
+    # One PLC's memory and Modbus TCP request handling. Every table holds `size` addresses from 0.
+    def __init__(self, coils, discrete_inputs, holding_registers, input_registers):
+        self.bits = {1: [False] * coils, 2: [i % 3 == 0 for i in range(discrete_inputs)]}
+        self.registers = {3: [i for i in range(holding_registers)], 4: [i * 2 for i in range(input_registers)]}
+
+    def handle(self, pdu):
+        function_code = pdu[0]
+        try:
+            if function_code in (1, 2):
+                address, count = struct.unpack('>HH', pdu[1:5])
+                bits = self.bits[function_code]
+                if count < 1 or address + count > len(bits):
+                    return self.exception(function_code, 2)
+                packed = bytearray((count + 7) // 8)
+                for i, bit in enumerate(bits[address:address + count]):
+                    if bit:
+                        packed[i // 8] |= 1 << (i % 8)
+                return bytes([function_code, len(packed)]) + bytes(packed)
+            if function_code in (3, 4):
+                address, count = struct.unpack('>HH', pdu[1:5])
+                registers = self.registers[function_code]
+                if count < 1 or address + count > len(registers):
+                    return self.exception(function_code, 2)
+                return bytes([function_code, count * 2]) + struct.pack(f'>{count}H', *registers[address:address + count])
+            if function_code == 5:
+                address, value = struct.unpack('>HH', pdu[1:5])
+                if address >= len(self.bits[1]):
+                    return self.exception(function_code, 2)
+                self.bits[1][address] = value == 0xFF00
+                return pdu[:5]
+            if function_code == 6:
+                address, value = struct.unpack('>HH', pdu[1:5])
+                if address >= len(self.registers[3]):
+                    return self.exception(function_code, 2)
+                self.registers[3][address] = value
+                return pdu[:5]
+            if function_code == 15:
+                address, count, _ = struct.unpack('>HHB', pdu[1:6])
+                if address + count > len(self.bits[1]):
+                    return self.exception(function_code, 2)
+                for i in range(count):
+                    self.bits[1][address + i] = bool(pdu[6 + i // 8] >> (i % 8) & 1)
+                return pdu[:5]
+            if function_code == 16:
+                address, count, _ = struct.unpack('>HHB', pdu[1:6])
+                if address + count > len(self.registers[3]):
+                    return self.exception(function_code, 2)
+                self.registers[3][address:address + count] = struct.unpack(f'>{count}H', pdu[6:6 + count * 2])
+                return pdu[:5]
+            if function_code == 0x2B and pdu[1] == 0x0E:
+                read_code = pdu[2]
+                body = bytes([0x2B, 0x0E, read_code, 0x01, 0x00, 0x00, len(DEVICE_INFORMATION)])
+                for object_id, value in DEVICE_INFORMATION.items():
+                    body += bytes([object_id, len(value)]) + value
+                return body
+        except (struct.error, IndexError):
+            return self.exception(function_code, 3)
+        return self.exception(function_code, 1)
+
+    def exception(self, function_code, code):
+        return bytes([function_code | 0x80, code])
+
+
+def run_fleet(addresses, port, layout, latency, jitter, exception_rate, counters, ready):
+    # Simulator process: serves every device on its own loopback address until terminated
+    async def serve(device, reader, writer):
+        loop = asyncio.get_running_loop()
+        outgoing = asyncio.Queue()
+
+        async def send():
+            # Replies leave in request order, each no earlier than its request's arrival plus the injected delay
+            while True:
+                due, frame = await outgoing.get()
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(frame)
+
+        sender = asyncio.create_task(send())
+        last_due = 0.0
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit = struct.unpack('>HHHB', header)
+                pdu = await reader.readexactly(length - 1)
+                if exception_rate and random.random() < exception_rate:
+                    response = device.exception(pdu[0], 6)  # Server device busy
+                else:
+                    response = device.handle(pdu)
+                with counters.get_lock():
+                    counters[0] += 1
+                    if response[0] & 0x80:
+                        counters[1] += 1
+                due = max(loop.time() + max(0.0, random.gauss(latency, jitter) if jitter else latency), last_due)
+                last_due = due
+                outgoing.put_nowait((due, struct.pack('>HHHB', transaction_id, protocol_id, len(response) + 1, unit) + response))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def main():
+        servers = []
+        for address in addresses:
+            device = SimulatedDevice(**layout)
+            servers.append(await asyncio.start_server(lambda r, w, device=device: serve(device, r, w), address, port))
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def latency_summary(seconds):
+    return {
+        'count': len(seconds),
+        'p50_ms': percentile(seconds, 0.50) * 1000 if seconds else None,
+        'p99_ms': percentile(seconds, 0.99) * 1000 if seconds else None,
+        'max_ms': max(seconds) * 1000 if seconds else None
+    }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Phase:
+    # Times one benchmark phase and counts the requests the simulator served during it
+    def __init__(self, counters):
+        self.counters = counters
+
+    def __enter__(self):
+        self.requests = self.counters[0]
+        self.exceptions = self.counters[1]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.request_count = self.counters[0] - self.requests
+        self.exception_count = self.counters[1] - self.exceptions
+
+    def result(self, **extra):
+        result = {
+            'seconds': self.seconds,
+            'requests': self.request_count,
+            'exception_responses': self.exception_count,
+            'requests_per_second': self.request_count / self.seconds if self.seconds else None,
+            'peak_rss_mb': peak_rss_mb()
+        }
+        result.update(extra)
+        return result
+
+
+def run_benchmark(args):
+    network = ipaddress.ip_network(f'127.1.0.0/{32 - math.ceil(math.log2(args.devices + 2))}')
+    addresses = [str(address) for address in list(network.hosts())[:args.devices]]
+    layout = {
+        'coils': args.coils,
+        'discrete_inputs': args.coils,
+        'holding_registers': args.registers,
+        'input_registers': args.registers
+    }
+    counters = multiprocessing.Array('q', 2)
+    ready = multiprocessing.Event()
+    simulator = multiprocessing.Process(
+        target=run_fleet,
+        args=(addresses, args.port, layout, args.latency_ms / 1000, args.jitter_ms / 1000, args.exception_rate, counters, ready),
+        daemon=True
+    )
+    simulator.start()
+    if not ready.wait(30):
+        raise RuntimeError("Simulated fleet did not start")
+
+    scanner = PLCFramework.ModbusScanner(network=str(network))
+    scanner.modbus_port = args.port
+    scanner.scan_ports = [args.port]
+    scanner.cache_path = None
+    scanner.connect_timeout = 0.5
+    scanner.discover_memory = args.discover
+    scanner.pool.pipeline_depth = args.pipeline
+    phases = {}
+    try:
+        with Phase(counters) as phase:
+            found = scanner.connect_scan()
+        phases['connect_scan'] = phase.result(hosts_found=len(found))
+
+        host_times = []
+        scan_host = scanner.scan_host
+
+        def timed_scan_host(ip, unit=None):
+            start = time.perf_counter()
+            try:
+                return scan_host(ip, unit)
+            finally:
+                host_times.append(time.perf_counter() - start)
+
+        scanner.scan_host = timed_scan_host
+        with Phase(counters) as phase:
+            scanner.modbus_scan()
+        scanner.scan_host = scan_host
+        servers = [device for device in scanner.clients if device.role == "Server"]
+        phases['modbus_scan'] = phase.result(devices_found=len(scanner.clients), servers=len(servers), per_device=latency_summary(host_times))
+
+        read_times = []
+        with Phase(counters) as phase:
+            for device in servers:
+                ranges = scanner.memory_map_ranges(device.memory_map)
+                with scanner.pool.borrow(device.ip, args.port) as client:
+                    for _ in range(args.reads):
+                        start = time.perf_counter()
+                        scanner.read_modbus_memory(client, ranges=ranges)
+                        read_times.append(time.perf_counter() - start)
+        phases['read_modbus_memory'] = phase.result(latency=latency_summary(read_times))
+
+        with Phase(counters) as phase:
+            stats = scanner.poll_devices([device.ip for device in servers], args.poll_rate, args.polls)
+        phases['poll_device'] = phase.result(
+            overruns=sum(device_stats['overruns'] for device_stats in stats.values()),
+            mean_jitter_ms=sum(device_stats['jitter'] for device_stats in stats.values()) / max(1, len(stats)) * 1000,
+            max_lateness_ms=max((device_stats['max_lateness'] for device_stats in stats.values()), default=0) * 1000
+        )
+
+        write_times = []
+        failures = 0
+        with Phase(counters) as phase:
+            for device in servers:
+                changes = [('holding_registers', address, address + 1) for address in range(min(args.writes, args.registers))]
+                with scanner.pool.borrow(device.ip, args.port) as client:
+                    start = time.perf_counter()
+                    failures += len(scanner.write_batch(client, changes, device.memory_map))
+                    write_times.append(time.perf_counter() - start)
+        phases['write_batch'] = phase.result(latency=latency_summary(write_times), failures=failures)
+    finally:
+        scanner.pool.close_all()
+        simulator.terminate()
+        simulator.join()
+    return phases
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=FRAMEWORK_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(previous, current):
+    # Relative change of each numeric metric present in both runs
+    for phase, metrics in current['phases'].items():
+        old_metrics = previous.get('phases', {}).get(phase)
+        if old_metrics is None:
+            continue
+        for name in ('seconds', 'requests_per_second', 'peak_rss_mb'):
+            old, new = old_metrics.get(name), metrics.get(name)
+            if old and new is not None:
+                print(f"{phase:20} {name:20} {old:12.3f} -> {new:12.3f} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ModbusScanner against a simulated PLC fleet")
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--coils', type=int, default=100, help="Coils and discrete inputs per device")
+    parser.add_argument('--registers', type=int, default=100, help="Holding and input registers per device")
+    parser.add_argument('--latency-ms', type=float, default=2.0, help="Mean injected response delay")
+    parser.add_argument('--jitter-ms', type=float, default=0.5, help="Standard deviation of the injected delay")
+    parser.add_argument('--exception-rate', type=float, default=0.0, help="Fraction of requests answered with a busy exception")
+    parser.add_argument('--pipeline', type=int, default=1, help="Requests in flight per connection")
+    parser.add_argument('--discover', action='store_true', help="Use full address-space discovery while scanning")
+    parser.add_argument('--reads', type=int, default=20, help="Memory reads per device")
+    parser.add_argument('--polls', type=int, default=20, help="Polls per device")
+    parser.add_argument('--poll-rate', type=float, default=0.1, help="Seconds between polls")
+    parser.add_argument('--writes', type=int, default=50, help="Registers written per device")
+    parser.add_argument('--output', help="Where to save the JSON results (default Benchmarks/results/)")
+    parser.add_argument('--compare', help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    phases = run_benchmark(args)
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'phases': phases
+    }
+    print(json.dumps(results, indent=2))
+
+    output = args.output
+    if output is None:
+        results_dir = os.path.join(FRAMEWORK_DIR, 'Benchmarks', 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit'] or 'unknown'}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
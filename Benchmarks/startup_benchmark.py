@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Measures how long PLCFramework.py takes to start, so cron and automation runs stay fast.
+# Run from anywhere: python Benchmarks/startup_benchmark.py [--runs N] [--max-ms LIMIT]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FRAMEWORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only load once an operation needs them
+DEFERRED_MODULES = ['numpy', 'pymodbus', 'prettytable', 'netifaces', 'nmap', 'asyncio']
+
+
+def time_command(command, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=FRAMEWORK_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time benchmark for PLCFramework.py")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, help="Exit non-zero if the median import time is above this")
+    args = parser.parse_args()
+
+    baseline = time_command([sys.executable, '-c', 'pass'], args.runs)
+    imported = time_command([sys.executable, '-c', 'import PLCFramework'], args.runs)
+    help_run = time_command([sys.executable, 'PLCFramework.py', '--help'], args.runs)
+    print(f"Interpreter only:      median {statistics.median(baseline):.1f}ms, min {min(baseline):.1f}ms")
+    print(f"import PLCFramework:   median {statistics.median(imported):.1f}ms, min {min(imported):.1f}ms")
+    print(f"PLCFramework.py --help median {statistics.median(help_run):.1f}ms, min {min(help_run):.1f}ms")
+
+    check = f"import sys, PLCFramework; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, '-c', check], cwd=FRAMEWORK_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    failed = False
+    if loaded:
+        print(f"Loaded at import time but should be deferred: {loaded}")
+        failed = True
+    if args.max_ms is not None and statistics.median(imported) > args.max_ms:
+        print(f"Median import time is above the {args.max_ms}ms limit")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
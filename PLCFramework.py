@@ -1,67 +1,1975 @@
 #!/usr/bin/env python3
-import subprocess
 import logging
-import nmap
-import netifaces
 import ipaddress
-from pymodbus.client import ModbusTcpClient
-from pymodbus.mei_message import ReadDeviceInformationRequest
-from pymodbus.exceptions import ModbusException
-from prettytable import PrettyTable
+import importlib
+import argparse
+import sys
 import socket
-import numpy as np
+import os
+import json
+import csv
+import struct
 import time
+import random
+import re
+from bisect import bisect_left
+from collections.abc import Mapping
+import threading
+from contextlib import contextmanager
+from functools import partial
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 
 
-class ModbusScanner:
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access, so a run only pays for the
+    # dependencies the requested operation actually uses
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+asyncio = LazyModule('asyncio')
+futures = LazyModule('concurrent.futures')
+shutil = LazyModule('shutil')
+np = LazyModule('numpy')
+netifaces = LazyModule('netifaces')
+curses = LazyModule('curses')
+modbus_client = LazyModule('pymodbus.client')
+modbus_exceptions = LazyModule('pymodbus.exceptions')
+modbus_factory = LazyModule('pymodbus.factory')
+mei_message = LazyModule('pymodbus.mei_message')
+bit_read_message = LazyModule('pymodbus.bit_read_message')
+bit_write_message = LazyModule('pymodbus.bit_write_message')
+register_read_message = LazyModule('pymodbus.register_read_message')
+register_write_message = LazyModule('pymodbus.register_write_message')
+pyarrow = LazyModule('pyarrow')
+parquet = LazyModule('pyarrow.parquet')
+
+# Largest quantity a single read request may ask for, per the Modbus application protocol spec
+MAX_READ_COUNT = {
+    'coils': 2000,
+    'discrete_inputs': 2000,
+    'holding_registers': 125,
+    'input_registers': 125
+}
+
+BIT_SECTIONS = ('coils', 'discrete_inputs')
+
+# Prefix length of the subnet each device is filed under in the scan cache
+CACHE_PREFIX = 24
+
+
+def parse_targets(targets):
+    # Turns CIDRs, addresses and ranges ("10.0.0.10-10.0.0.50" or "10.0.0.10-50"), given as a list or a
+    # comma separated string, into sorted, non-overlapping (first, last) address ranges. A CIDR covers its
+    # usable host addresses, so a network and its subnets or two overlapping VLANs are only swept once.
+    if isinstance(targets, str):
+        targets = [targets]
+    ranges = []
+    for target in (target for targets_string in targets for target in str(targets_string).split(',')):
+        target = target.strip()
+        if not target:
+            continue
+        if '-' in target:
+            first, last = target.split('-')
+            first = ipaddress.IPv4Address(first.strip())
+            last = last.strip()
+            if '.' not in last:
+                last = '.'.join(str(first).split('.')[:3] + [last])
+            last = ipaddress.IPv4Address(last)
+            if last < first:
+                raise ValueError(f"Range ends before it starts: {target}")
+            ranges.append((first, last))
+        else:
+            network = ipaddress.IPv4Network(target, strict=False)
+            hosts = (network[1], network[-2]) if network.prefixlen < 31 else (network[0], network[-1])
+            ranges.append(hosts)
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges):
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and int(first) <= int(merged[-1][1]) + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def format_range(first, last):
+    return str(first) if first == last else f"{first}-{last}"
+
+
+def split_ranges(ranges, prefix):
+    # Cuts ranges at prefix sized subnet boundaries, e.g. for handing /24 sized shards to workers
+    size = 2 ** (32 - prefix)
+    shards = []
+    for first, last in ranges:
+        start = int(first)
+        while start <= int(last):
+            end = min(int(last), (start // size + 1) * size - 1)
+            shards.append((ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)))
+            start = end + 1
+    return shards
+
+
+def iter_addresses(ranges):
+    # Yields every address of every range, taking one from each range in turn so all of them are swept
+    # side by side instead of one VLAN after the other
+    ranges = [range(int(first), int(last) + 1) for first, last in ranges]
+    for offset in range(max((len(addresses) for addresses in ranges), default=0)):
+        for addresses in ranges:
+            if offset < len(addresses):
+                yield ipaddress.IPv4Address(addresses[offset])
+
+
+def cache_network(ip):
+    return str(ipaddress.ip_network(f"{ip}/{CACHE_PREFIX}", strict=False))
+
+# Writable tables, by the menu's display names as well as the section keys
+WRITE_SECTIONS = {
+    'Coil': 'coils',
+    'Holding Register': 'holding_registers',
+    'coils': 'coils',
+    'holding_registers': 'holding_registers'
+}
+
+# Largest quantity one function code 15/16 request may write
+MAX_WRITE_COUNT = {
+    'coils': 1968,
+    'holding_registers': 123
+}
+
+WRITE_SINGLE_REQUESTS = {
+    'coils': (bit_write_message, 'WriteSingleCoilRequest'),
+    'holding_registers': (register_write_message, 'WriteSingleRegisterRequest')
+}
+WRITE_MULTIPLE_REQUESTS = {
+    'coils': (bit_write_message, 'WriteMultipleCoilsRequest'),
+    'holding_registers': (register_write_message, 'WriteMultipleRegistersRequest')
+}
+WRITE_SINGLE_METHODS = {'coils': 'write_coil', 'holding_registers': 'write_register'}
+WRITE_MULTIPLE_METHODS = {'coils': 'write_coils', 'holding_registers': 'write_registers'}
+
+CAPTURE_MAGIC = b'PLCCAP01'
+
+# Table each function code works on, for labelling request metrics
+FUNCTION_SECTIONS = {
+    1: 'coils',
+    2: 'discrete_inputs',
+    3: 'holding_registers',
+    4: 'input_registers',
+    5: 'coils',
+    6: 'holding_registers',
+    15: 'coils',
+    16: 'holding_registers',
+    43: 'device_identification'
+}
+
+# Exception codes a gateway answers with itself when the serial device behind it doesn't: gateway path
+# unavailable and gateway target device failed to respond
+GATEWAY_EXCEPTIONS = (0x0A, 0x0B)
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+READ_REQUESTS = {
+    'coils': (bit_read_message, 'ReadCoilsRequest'),
+    'discrete_inputs': (bit_read_message, 'ReadDiscreteInputsRequest'),
+    'holding_registers': (register_read_message, 'ReadHoldingRegistersRequest'),
+    'input_registers': (register_read_message, 'ReadInputRegistersRequest')
+}
+
+
+def modbus_request(requests, section, *args, **kwargs):
+    # Builds the pymodbus request for `section` from one of the *_REQUESTS tables
+    module, name = requests[section]
+    return getattr(module, name)(*args, **kwargs)
+
+
+class PipelinedModbusClient:
+    # Stands in for the parts of ModbusTcpClient the scanner uses, but keeps up to `window`
+    # requests in flight on one socket and matches the replies by MBAP transaction ID
+    def __init__(self, host, port=502, unit=1, window=8, timeout=3, metrics=None, policies=None):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.window = window
+        self.timeout = timeout  # Seconds each request may wait for its reply, unless a policy sets it
+        self.metrics = metrics  # RequestMetrics to record each request in, or None
+        self.policies = policies  # Unit ID -> DevicePolicy for adaptive timeouts, retries and the circuit breaker, or None
+        self.device = f"{host}:{port}"
+        self.socket = None
+        self.buffer = b''
+        self.transaction_id = 0
+        self.decoder = modbus_factory.ClientDecoder()
+
+    def connect(self):
+        if self.socket is None:
+            try:
+                self.socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                logger.debug(f"Failed to connect to {self.host}:{self.port}: {e}")
+                return False
+        return True
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.buffer = b''
+
+    def is_socket_open(self):
+        return self.socket is not None
+
+    def read_coils(self, address, count=1, slave=None):
+        return self.execute(bit_read_message.ReadCoilsRequest(address, count, unit=self.unit if slave is None else slave))
+
+    def read_discrete_inputs(self, address, count=1, slave=None):
+        return self.execute(bit_read_message.ReadDiscreteInputsRequest(address, count, unit=self.unit if slave is None else slave))
+
+    def read_holding_registers(self, address, count=1, slave=None):
+        return self.execute(register_read_message.ReadHoldingRegistersRequest(address, count, unit=self.unit if slave is None else slave))
+
+    def read_input_registers(self, address, count=1, slave=None):
+        return self.execute(register_read_message.ReadInputRegistersRequest(address, count, unit=self.unit if slave is None else slave))
+
+    def write_coil(self, address, value, slave=None):
+        return self.execute(bit_write_message.WriteSingleCoilRequest(address, value, unit=self.unit if slave is None else slave))
+
+    def write_register(self, address, value, slave=None):
+        return self.execute(register_write_message.WriteSingleRegisterRequest(address, value, unit=self.unit if slave is None else slave))
+
+    def write_coils(self, address, values, slave=None):
+        return self.execute(bit_write_message.WriteMultipleCoilsRequest(address, values, unit=self.unit if slave is None else slave))
+
+    def write_registers(self, address, values, slave=None):
+        return self.execute(register_write_message.WriteMultipleRegistersRequest(address, values, unit=self.unit if slave is None else slave))
+
+    def execute(self, request):
+        return self.execute_many([request])[0]
+
+    def execute_many(self, requests):
+        # Returns one response per request, in request order. Timed out requests get a ModbusIOException,
+        # after being retried with backoff if there are policies. The requests of each unit are sent
+        # together under that unit's policy, so a silent unit behind a gateway only trips its own breaker.
+        responses = [None] * len(requests)
+        units = {}
+        for i, request in enumerate(requests):
+            units.setdefault(request.unit_id, []).append(i)
+        for unit, indices in units.items():
+            policy = self.policies(unit) if self.policies is not None else None
+            unit_requests = [requests[i] for i in indices]
+            unit_responses = self.execute_window(unit_requests, policy)
+            if policy is not None:
+                for attempt in range(policy.retry_budget):
+                    retry = [i for i, response in enumerate(unit_responses) if isinstance(response, modbus_exceptions.ModbusIOException)]
+                    if not retry:
+                        break
+                    time.sleep(policy.backoff_delay(attempt))
+                    for i, response in zip(retry, self.execute_window([unit_requests[i] for i in retry], policy)):
+                        unit_responses[i] = response
+            for i, response in zip(indices, unit_responses):
+                responses[i] = response
+        return responses
+
+    def execute_window(self, requests, policy=None):
+        if policy is not None and not policy.allow():
+            if self.metrics is not None:
+                for request in requests:
+                    self.metrics.record(self.device, request.function_code, 'rejected', 0.0)
+            raise modbus_exceptions.ConnectionException(f"{self.device} unit {requests[0].unit_id} skipped, circuit open after {policy.failures} consecutive failures")
+        timeout = self.timeout if policy is None else policy.timeout
+        if not self.connect():
+            if policy is not None:
+                policy.record_failure(timed_out=False)
+            if self.metrics is not None:
+                for request in requests:
+                    self.metrics.record(self.device, request.function_code, 'error', 0.0)
+            raise modbus_exceptions.ConnectionException(f"Failed to connect to {self.host}:{self.port}")
+        responses = [None] * len(requests)
+        pending = {}  # transaction id -> (request index, deadline, send time), in send order
+        next_index = 0
+        while next_index < len(requests) or pending:
+            while next_index < len(requests) and len(pending) < self.window:
+                request = requests[next_index]
+                transaction_id = self.send(request)
+                sent = time.monotonic()
+                pending[transaction_id] = (next_index, sent + timeout, sent)
+                next_index += 1
+
+            oldest = next(iter(pending))
+            frame = self.receive(min(deadline for _, deadline, _ in pending.values()))
+            if frame is None:
+                now = time.monotonic()
+                for transaction_id, (index, deadline, sent) in list(pending.items()):
+                    if deadline <= now:
+                        responses[index] = modbus_exceptions.ModbusIOException(f"No response from {self.host}:{self.port} within {timeout:.3f} seconds")
+                        if self.metrics is not None:
+                            self.metrics.record(self.device, requests[index].function_code, 'timeout', now - sent)
+                        if policy is not None:
+                            policy.record_failure()
+                        del pending[transaction_id]
+                self.fall_back("dropped a request")
+                continue
+
+            transaction_id, pdu = frame
+            if transaction_id not in pending:
+                continue  # Late reply to a request that already timed out
+            if transaction_id != oldest:
+                self.fall_back("answered out of order")
+            index, _, sent = pending.pop(transaction_id)
+            responses[index] = self.decoder.decode(pdu)
+            rtt = time.monotonic() - sent
+            if self.metrics is not None:
+                self.metrics.record_response(self.device, requests[index].function_code, responses[index], rtt)
+            if policy is not None:
+                policy.observe(rtt)
+        return responses
+
+    def fall_back(self, reason):
+        if self.window > 1:
+            logger.warning(f"{self.host}:{self.port} {reason}, falling back to one request in flight")
+            self.window = 1
+
+    def send(self, request):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        pdu = struct.pack('>B', request.function_code) + request.encode()
+        header = struct.pack('>HHHB', self.transaction_id, 0, len(pdu) + 1, request.unit_id)
+        try:
+            self.socket.sendall(header + pdu)
+            if self.metrics is not None:
+                self.metrics.record_bytes(self.device, sent=len(header) + len(pdu))
+        except OSError as e:
+            self.close()
+            raise modbus_exceptions.ConnectionException(f"Failed to send to {self.host}:{self.port}: {e}")
+        return self.transaction_id
+
+    def receive(self, deadline):
+        # Returns (transaction id, pdu) for the next complete frame, or None once the deadline passes
+        while True:
+            if len(self.buffer) >= 7:
+                transaction_id, _, length, _ = struct.unpack('>HHHB', self.buffer[:7])
+                if len(self.buffer) >= 6 + length:
+                    pdu = self.buffer[7:6 + length]
+                    self.buffer = self.buffer[6 + length:]
+                    return transaction_id, pdu
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.socket.settimeout(remaining)
+            try:
+                data = self.socket.recv(4096)
+            except socket.timeout:
+                return None
+            except OSError as e:
+                self.close()
+                raise modbus_exceptions.ConnectionException(f"Failed to receive from {self.host}:{self.port}: {e}")
+            if not data:
+                self.close()
+                raise modbus_exceptions.ConnectionException(f"{self.host}:{self.port} closed the connection")
+            if self.metrics is not None:
+                self.metrics.record_bytes(self.device, received=len(data))
+            self.buffer += data
+
+
+def address_ranges(addresses):
+    # Contiguous (start, count) runs in a sorted address array
+    if len(addresses) == 0:
+        return []
+    addresses = np.asarray(addresses, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(addresses) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(addresses)]))
+    return list(zip(addresses[starts].tolist(), (ends - starts).tolist()))
+
+
+class MemorySection(Mapping):
+    # One table of a device's memory map, stored as a sorted uint16 address array and a value array:
+    # uint16 for registers, a packed bitset for coils and discrete inputs. Reads like {address: value}.
+    __slots__ = ('name', 'addresses', 'data')
+
+    def __init__(self, name, addresses, values):
+        addresses = np.asarray(addresses, dtype=np.uint16)
+        order = np.argsort(addresses, kind='stable')
+        self.name = name
+        self.addresses = addresses[order]
+        if name in BIT_SECTIONS:
+            self.data = np.packbits(np.asarray(values, dtype=bool)[order])
+        else:
+            self.data = np.asarray(values, dtype=np.uint16)[order]
+
+    @classmethod
+    def from_dict(cls, name, values):
+        return cls(name, np.fromiter(values.keys(), dtype=np.uint16, count=len(values)), list(values.values()))
+
+    def values_array(self):
+        if self.name in BIT_SECTIONS:
+            return np.unpackbits(self.data, count=len(self.addresses)).astype(bool)
+        return self.data
+
+    def index(self, address):
+        i = int(np.searchsorted(self.addresses, address))
+        if i < len(self.addresses) and self.addresses[i] == address:
+            return i
+        raise KeyError(address)
+
+    def __getitem__(self, address):
+        i = self.index(address)
+        if self.name in BIT_SECTIONS:
+            return bool(self.data[i >> 3] >> (7 - (i & 7)) & 1)
+        return int(self.data[i])
+
+    def __setitem__(self, address, value):
+        # The layout is fixed, only addresses already in the section can be updated
+        i = self.index(address)
+        if self.name in BIT_SECTIONS:
+            mask = 1 << (7 - (i & 7))
+            self.data[i >> 3] = (self.data[i >> 3] | mask) if value else (self.data[i >> 3] & (0xFF ^ mask))
+        else:
+            self.data[i] = value
+
+    def __contains__(self, address):
+        i = int(np.searchsorted(self.addresses, address))
+        return i < len(self.addresses) and self.addresses[i] == address
+
+    def __iter__(self):
+        return iter(self.addresses.tolist())
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def items(self):
+        return list(zip(self.addresses.tolist(), self.values_array().tolist()))
+
+    def values(self):
+        return self.values_array().tolist()
+
+    def ranges(self):
+        return address_ranges(self.addresses)
+
+    def diff(self, other):
+        # (address, old, new) for every address both sections hold with different values
+        common, mine, theirs = np.intersect1d(self.addresses, other.addresses, assume_unique=True, return_indices=True)
+        old = self.values_array()[mine]
+        new = other.values_array()[theirs]
+        changed = np.flatnonzero(old != new)
+        return list(zip(common[changed].tolist(), old[changed].tolist(), new[changed].tolist()))
+
+
+def compact_memory_map(memory_map):
+    return {section: values if isinstance(values, MemorySection) else MemorySection.from_dict(section, values)
+            for section, values in memory_map.items()}
+
+
+def section_arrays(values):
+    # (addresses, values) arrays for a section held either as a MemorySection or a plain dict
+    if isinstance(values, MemorySection):
+        return values.addresses, values.values_array()
+    return np.fromiter(values.keys(), dtype=np.uint16, count=len(values)), np.fromiter(values.values(), dtype=np.int32, count=len(values))
+
+
+class Device:
+    # One scanned host, or one unit behind a gateway when unit is set. Unpacks like the
+    # (ip, device_info, role, memory_map) tuples the menus use.
+    __slots__ = ('ip', 'device_info', 'role', 'memory_map', 'unit', 'incomplete')
+
+    def __init__(self, ip, device_info=None, role=None, memory_map=None, unit=None, incomplete=False):
+        self.ip = ip
+        self.device_info = device_info
+        self.role = role
+        self.memory_map = compact_memory_map(memory_map) if memory_map is not None else None
+        self.unit = unit
+        self.incomplete = incomplete  # A read timed out or failed, so the role and memory map may be wrong
+
+    @property
+    def key(self):
+        # "ip", or "ip/unit" for a unit behind a gateway; used to key caches, history and polls
+        return self.ip if self.unit is None else f"{self.ip}/{self.unit}"
+
+    def __iter__(self):
+        return iter((self.ip, self.device_info, self.role, self.memory_map))
+
+    def __getitem__(self, index):
+        return (self.ip, self.device_info, self.role, self.memory_map)[index]
+
+    def __len__(self):
+        return 4
+
+    def __repr__(self):
+        return f"Device({self.key!r}, role={self.role!r})"
+
+    def as_dict(self):
+        # Plain JSON-ready form; identification bytes become latin-1 text
+        device_info = None
+        if self.device_info is not None:
+            device_info = {key: value.decode('latin-1') if isinstance(value, bytes) else value for key, value in self.device_info.items()}
+        memory_map = None
+        if self.memory_map is not None:
+            memory_map = {section: dict(values.items()) for section, values in self.memory_map.items()}
+        device = {'ip': self.ip, 'device_info': device_info, 'role': self.role, 'memory_map': memory_map}
+        if self.unit is not None:
+            device['unit'] = self.unit
+        return device
+
+
+def parse_device_key(key):
+    # "10.0.0.5/3" -> ('10.0.0.5', 3), "10.0.0.5" -> ('10.0.0.5', None)
+    ip, _, unit = key.partition('/')
+    return ip, int(unit) if unit else None
+
+
+def device_sort_key(device):
+    return ipaddress.ip_address(device.ip), -1 if device.unit is None else device.unit
+
+
+def pack_sample(section, addresses, values):
+    # One poll of a section as a row: uint16 per register, or packed bits for coils and discrete inputs.
+    # A read laid out like the row is copied straight from its arrays, anything else is aligned by address.
+    if not isinstance(values, MemorySection):
+        values = MemorySection.from_dict(section, values)
+    if np.array_equal(values.addresses, addresses):
+        return values.data
+    sample = np.zeros(len(addresses), dtype=np.uint16)
+    if len(values):
+        index = np.minimum(np.searchsorted(values.addresses, addresses), len(values) - 1)
+        found = values.addresses[index] == addresses
+        sample[found] = values.values_array()[index[found]]
+    if section in BIT_SECTIONS:
+        return np.packbits(sample.astype(bool))
+    return sample
+
+
+def is_complete_sample(addresses, memory_map):
+    # A failed poll comes back empty and one with a failed block comes back short of addresses. Packing
+    # either would store zeros for values that were never read.
+    return all(len(memory_map.get(section, ())) >= len(section_addresses) for section, section_addresses in addresses.items())
+
+
+class PollCapture:
+    # Append-only capture file for long poll sessions. The file starts with CAPTURE_MAGIC, a uint32
+    # header length and a JSON header holding the address layout and record dtype, padded so the
+    # records start on a 64 byte boundary. Each record is one poll: a float64 timestamp then one
+    # field per section laid out like PollHistory rows. Records are written a chunk at a time.
+    def __init__(self, path, memory_map, chunk_rows=256):
+        self.path = path
+        self.addresses = {section: section_arrays(values)[0] for section, values in memory_map.items()}
+        fields = [('timestamp', '<f8')]
+        for section, addresses in self.addresses.items():
+            if section in BIT_SECTIONS:
+                fields.append((section, 'u1', ((len(addresses) + 7) // 8,)))
+            else:
+                fields.append((section, '<u2', (len(addresses),)))
+        self.dtype = np.dtype(fields)
+        self.chunk = np.zeros(chunk_rows, dtype=self.dtype)
+        self.rows = 0  # Rows waiting in self.chunk
+
+        header = json.dumps({
+            'sections': {section: addresses.tolist() for section, addresses in self.addresses.items()},
+            'dtype': [(name, self.dtype[name].base.str, self.dtype[name].shape) for name in self.dtype.names],
+            'chunk_rows': chunk_rows
+        }).encode()
+        padding = -(len(CAPTURE_MAGIC) + 4 + len(header)) % 64
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC + struct.pack('<I', len(header) + padding) + header + b' ' * padding)
+        self.file.flush()
+
+    def append(self, memory_map, timestamp=None):
+        if not is_complete_sample(self.addresses, memory_map):
+            return
+        record = self.chunk[self.rows]
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        for section, addresses in self.addresses.items():
+            record[section] = pack_sample(section, addresses, memory_map.get(section, {}))
+        self.rows += 1
+        if self.rows == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.file.write(self.chunk[:self.rows].tobytes())
+            self.file.flush()
+            self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def open_capture(path):
+    # Returns (header, records) where records is a read-only numpy.memmap over every complete poll in
+    # the file, so any time range or section can be sliced without loading the rest
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a poll capture file")
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length))
+    dtype = np.dtype([(name, base, tuple(shape)) for name, base, shape in header['dtype']])
+    offset = len(CAPTURE_MAGIC) + 4 + header_length
+    rows = (os.path.getsize(path) - offset) // dtype.itemsize
+    if rows == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(rows,))
+
+
+def unpack_bits(header, section, values):
+    # Expand packed coil or discrete input rows from a capture back to one column per address
+    return np.unpackbits(values, axis=-1, count=len(header['sections'][section]))
+
+
+# Columns of the exported tables as (name, type), one row per device, per memory address or per polled value
+INVENTORY_FIELDS = [('ip', 'string'), ('unit', 'int64'), ('role', 'string'), ('vendor_name', 'string'),
+                    ('product_code', 'string'), ('revision', 'string'), ('addresses', 'int64')]
+MEMORY_FIELDS = [('ip', 'string'), ('unit', 'int64'), ('section', 'string'), ('address', 'int64'), ('value', 'int64')]
+SAMPLE_FIELDS = [('timestamp', 'float64'), ('ip', 'string'), ('unit', 'int64'), ('poll', 'int64'),
+                 ('section', 'string'), ('address', 'int64'), ('value', 'int64')]
+CHANGE_FIELDS = [('timestamp', 'float64'), ('ip', 'string'), ('unit', 'int64'), ('section', 'string'),
+                 ('address', 'int64'), ('old', 'int64'), ('new', 'int64')]
+
+
+def inventory_rows(device):
+    device_info = device.as_dict()['device_info'] or {}
+    # Basic identification objects, keyed by object id as pymodbus returns them
+    vendor_name, product_code, revision = (device_info.get(object_id) for object_id in (0, 1, 2))
+    addresses = sum(len(values) for values in device.memory_map.values()) if device.memory_map is not None else 0
+    return [(device.ip, device.unit, device.role, vendor_name, product_code, revision, addresses)]
+
+
+def memory_rows(device):
+    if device.memory_map is None:
+        return []
+    return [(device.ip, device.unit, section, address, int(value))
+            for section, values in device.memory_map.items() for address, value in values.items()]
+
+
+def sample_rows(key, poll_num, timestamp, memory_map):
+    ip, unit = parse_device_key(key)
+    return [(timestamp, ip, unit, poll_num, section, address, int(value))
+            for section, values in memory_map.items() for address, value in values.items()]
+
+
+def change_rows(key, events):
+    ip, unit = parse_device_key(key)
+    return [(timestamp, ip, unit, section, address, int(old), int(new)) for section, address, old, new, timestamp in events]
+
+
+class Exporter:
+    # Streams rows of a fixed set of fields to a file. Rows are buffered and written batch_rows at a
+    # time, so a fleet-wide poll never holds more than one batch in memory. Safe to write from the
+    # polling threads.
+    def __init__(self, path, fields, batch_rows=4096):
+        self.path = path
+        self.fields = fields
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def write(self, rows):
+        with self.lock:
+            self.rows.extend(rows)
+            if len(self.rows) >= self.batch_rows:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.rows:
+            self.write_batch(self.rows)
+            self.written += len(self.rows)
+            self.rows = []
+
+    def close(self):
+        with self.lock:
+            self.flush_locked()
+            self.close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvExporter(Exporter):
+    def __init__(self, path, fields, batch_rows=4096):
+        super().__init__(path, fields, batch_rows)
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in fields])
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close_file(self):
+        self.file.close()
+
+
+class JsonlExporter(Exporter):
+    def __init__(self, path, fields, batch_rows=4096):
+        super().__init__(path, fields, batch_rows)
+        self.names = [name for name, _ in fields]
+        self.file = open(path, 'w')
+
+    def write_batch(self, rows):
+        self.file.write(''.join(json.dumps(dict(zip(self.names, row))) + '\n' for row in rows))
+        self.file.flush()
+
+    def close_file(self):
+        self.file.close()
+
+
+class ParquetExporter(Exporter):
+    # Each batch becomes one row group, so readers can start on the file as soon as it is closed
+    # without the whole poll session ever being held as one table
+    def __init__(self, path, fields, batch_rows=65536):
+        super().__init__(path, fields, batch_rows)
+        try:
+            self.schema = pyarrow.schema([(name, getattr(pyarrow, field_type)()) for name, field_type in fields])
+        except ImportError as e:
+            raise RuntimeError("Parquet export needs pyarrow installed") from e
+        self.writer = parquet.ParquetWriter(path, self.schema)
+
+    def write_batch(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema))
+
+    def close_file(self):
+        self.writer.close()
+
+
+EXPORTERS = {'.csv': CsvExporter, '.jsonl': JsonlExporter, '.ndjson': JsonlExporter, '.parquet': ParquetExporter}
+
+
+def open_exporter(path, fields):
+    # Picks the format from the file extension: .csv, .jsonl/.ndjson or .parquet
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORTERS:
+        raise ValueError(f"Unknown export format {extension!r} for {path}, use one of {', '.join(EXPORTERS)}")
+    return EXPORTERS[extension](path, fields)
+
+
+class PollHistory:
+    # Fixed-size ring buffer of poll samples for one device. Registers are kept as uint16 and
+    # coils/discrete inputs as packed bits, one row per poll with a matching timestamp.
+    def __init__(self, memory_map, capacity=3600):
+        self.capacity = capacity
+        self.count = 0  # Samples appended so far, including ones already overwritten. Failed polls aren't stored.
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.addresses = {}
+        self.values = {}
+        for section, values in memory_map.items():
+            self.addresses[section] = section_arrays(values)[0]
+            if section in BIT_SECTIONS:
+                self.values[section] = np.zeros((capacity, (len(values) + 7) // 8), dtype=np.uint8)
+            else:
+                self.values[section] = np.zeros((capacity, len(values)), dtype=np.uint16)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, memory_map, timestamp=None):
+        if not is_complete_sample(self.addresses, memory_map):
+            return
+        row = self.count % self.capacity
+        self.timestamps[row] = time.time() if timestamp is None else timestamp
+        for section, addresses in self.addresses.items():
+            self.values[section][row] = pack_sample(section, addresses, memory_map.get(section, {}))
+        self.count += 1
+
+    def window(self, section, last=None):
+        # (timestamps, values) for the last `last` samples, oldest first. values has one row per sample
+        # and one column per address in self.addresses[section].
+        size = len(self) if last is None else min(last, len(self))
+        rows = np.arange(self.count - size, self.count) % self.capacity
+        values = self.values[section][rows]
+        if section in BIT_SECTIONS:
+            values = np.unpackbits(values, axis=1, count=len(self.addresses[section]))
+        return self.timestamps[rows], values
+
+    def summary(self, section, last=None):
+        _, values = self.window(section, last)
+        if len(values) == 0:
+            return None
+        return {'min': values.min(axis=0), 'max': values.max(axis=0), 'mean': values.mean(axis=0)}
+
+    def rate_of_change(self, section, last=None):
+        # Change per second between the first and last sample of the window, per address
+        timestamps, values = self.window(section, last)
+        if len(timestamps) < 2 or timestamps[-1] == timestamps[0]:
+            return np.zeros(len(self.addresses[section]))
+        return (values[-1].astype(np.float64) - values[0]) / (timestamps[-1] - timestamps[0])
+
+
+class ChangeDetector:
+    # Compares each new read of a device with the last reported values and returns only what changed,
+    # as (section, address, old, new, timestamp) events. A register with a deadband has to move by more
+    # than it from the last reported value before a change is reported.
+    def __init__(self, memory_map, deadbands=None):
+        deadbands = deadbands or {}
+        # Copies of the sections, so later writes to the device's memory map don't move the reported values
+        self.reported = {section: MemorySection(section, *section_arrays(values)) for section, values in memory_map.items()}
+        self.deadbands = {section: deadbands.get(section, {}) for section in memory_map}
+
+    def update(self, memory_map, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        events = []
+        for section, reported in self.reported.items():
+            new_section = memory_map.get(section)
+            if not new_section:
+                continue  # Nothing was read, which isn't a change
+            if not isinstance(new_section, MemorySection):
+                new_section = MemorySection.from_dict(section, new_section)
+            # Only addresses in both are compared, so ones missing from this read never count as changed
+            deadbands = self.deadbands[section]
+            for address, old, new in reported.diff(new_section):
+                if abs(int(new) - int(old)) > deadbands.get(address, 0):
+                    reported[address] = new
+                    events.append((section, address, int(old), int(new), timestamp))
+        return events
+
+
+class PollScheduler:
+    # Calls poll(poll_num) on a fixed grid of deadlines, start + n * period, so the time a read
+    # takes doesn't stretch the period. A poll that runs past the next deadline is an overrun and
+    # the missed slots are skipped rather than fired back to back.
+    def __init__(self, period, count=None):
+        if not period > 0:
+            raise ValueError(f"Polling period must be above 0 seconds, got {period}")
+        self.period = period
+        self.count = count
+        self.polls = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        # Running mean and variance of the time between poll starts (Welford), so hours of polling use constant memory
+        self.intervals = 0
+        self.mean_interval = 0.0
+        self.interval_m2 = 0.0
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, poll):
+        start = time.monotonic()
+        tick = 1
+        last_start = None
+        while not self.stopped.is_set() and (self.count is None or self.polls < self.count):
+            deadline = start + tick * self.period
+            delay = deadline - time.monotonic()
+            if delay > 0 and self.stopped.wait(delay):
+                break
+            poll_start = time.monotonic()
+            self.max_lateness = max(self.max_lateness, poll_start - deadline)
+            if last_start is not None:
+                self.record_interval(poll_start - last_start)
+            last_start = poll_start
+
+            poll(self.polls)
+            self.polls += 1
+            tick += 1
+            now = time.monotonic()
+            if now > start + tick * self.period:
+                next_tick = int((now - start) / self.period) + 1
+                self.overruns += 1
+                self.skipped += next_tick - tick
+                tick = next_tick
+
+    def record_interval(self, interval):
+        self.intervals += 1
+        delta = interval - self.mean_interval
+        self.mean_interval += delta / self.intervals
+        self.interval_m2 += delta * (interval - self.mean_interval)
+
+    def stats(self):
+        jitter = (self.interval_m2 / self.intervals) ** 0.5 if self.intervals else 0.0
+        return {
+            'polls': self.polls,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'mean_period': self.mean_interval if self.intervals else self.period,
+            'jitter': jitter,
+            'max_lateness': self.max_lateness
+        }
+
+
+SECTION_LABELS = {'coils': 'CO', 'discrete_inputs': 'DI', 'holding_registers': 'HR', 'input_registers': 'IR'}
+
+
+class PollDashboard:
+    # Live terminal view of devices being polled, one pane per device side by side. The poll threads only
+    # hand over their latest read through update() and mark_changes(); the screen is drawn by run() at no
+    # more than fps frames a second whatever the poll rate, and only cells whose text changed since the
+    # last frame are written to the terminal.
+    PANE_WIDTH = 32
+    HIGHLIGHT_SECONDS = 1.0  # How long a changed value stays highlighted
+
+    def __init__(self, memory_maps, fps=10):
+        self.fps = fps
+        self.keys = list(memory_maps)
+        self.rows = {key: [(section, address) for section, values in memory_map.items() for address in values.keys()]
+                     for key, memory_map in memory_maps.items()}
+        self.latest = {key: (0, None, memory_map) for key, memory_map in memory_maps.items()}  # key -> (polls, timestamp, memory map)
+        self.failed = {key: False for key in self.keys}
+        self.changed = {}  # (key, section, address) -> when it last changed
+        self.lock = threading.Lock()
+        self.offset = 0  # First address row shown
+        self.page = 0  # First device pane shown
+        self.cells = {}  # (y, x) -> (text, attribute) currently on screen
+
+    def update(self, key, poll_num, memory_map, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            if memory_map:
+                self.latest[key] = (poll_num + 1, timestamp, memory_map)
+            else:
+                self.latest[key] = (poll_num + 1, self.latest[key][1], self.latest[key][2])
+            self.failed[key] = not memory_map
+
+    def mark_changes(self, key, events):
+        with self.lock:
+            for section, address, _, _, timestamp in events:
+                self.changed[(key, section, address)] = timestamp
+
+    def run(self, stop, done):
+        # Draws until done() is true or q is pressed; q, like Ctrl+C, also sets stop so polling ends
+        try:
+            curses.wrapper(self.loop, stop, done)
+        except KeyboardInterrupt:
+            stop.set()
+
+    def loop(self, screen, stop, done):
+        curses.curs_set(0)
+        screen.timeout(int(1000 / self.fps))
+        self.cells = {}
+        while not done():
+            self.draw(screen)
+            key = screen.getch()  # Also paces the frames, waiting up to one frame for a key
+            height, _ = screen.getmaxyx()
+            visible_rows = max(1, height - 4)
+            if key in (ord('q'), ord('Q')):
+                stop.set()
+                return
+            elif key == curses.KEY_DOWN:
+                self.offset += 1
+            elif key == curses.KEY_UP:
+                self.offset -= 1
+            elif key == curses.KEY_NPAGE:
+                self.offset += visible_rows
+            elif key == curses.KEY_PPAGE:
+                self.offset -= visible_rows
+            elif key == curses.KEY_HOME:
+                self.offset = 0
+            elif key == curses.KEY_END:
+                self.offset = max(len(rows) for rows in self.rows.values())
+            elif key == curses.KEY_RIGHT:
+                self.page += 1
+            elif key == curses.KEY_LEFT:
+                self.page -= 1
+            elif key == curses.KEY_RESIZE:
+                screen.clear()
+                self.cells = {}
+
+    def frame(self, height, width):
+        # {(y, x): (text, attribute)} for everything that should be on screen
+        with self.lock:
+            latest = dict(self.latest)
+            failed = dict(self.failed)
+            changed = dict(self.changed)
+        now = time.time()
+        panes = max(1, width // self.PANE_WIDTH)
+        pane_width = width // min(panes, len(self.keys))
+        visible_rows = max(1, height - 4)
+        longest = max(len(rows) for rows in self.rows.values())
+        self.page = max(0, min(self.page, len(self.keys) - panes))
+        self.offset = max(0, min(self.offset, longest - visible_rows))
+
+        cells = {}
+        for pane, key in enumerate(self.keys[self.page:self.page + panes]):
+            x = pane * pane_width
+            polls, timestamp, memory_map = latest[key]
+            updated = time.strftime('%H:%M:%S', time.localtime(timestamp)) if timestamp else '-'
+            cells[(0, x)] = (key[:pane_width - 1], curses.A_BOLD)
+            cells[(1, x)] = (f"poll {polls} at {updated}"[:pane_width - 1], curses.A_REVERSE if failed[key] else curses.A_NORMAL)
+            cells[(2, x)] = ('-' * (pane_width - 1), curses.A_NORMAL)
+            for y, (section, address) in enumerate(self.rows[key][self.offset:self.offset + visible_rows], 3):
+                value = memory_map.get(section, {}).get(address)
+                recent = now - changed.get((key, section, address), 0) < self.HIGHLIGHT_SECONDS
+                text = f"{SECTION_LABELS.get(section, section)} {address:>5} {'-' if value is None else int(value):>7}"
+                cells[(y, x)] = (text[:pane_width - 1], curses.A_BOLD if recent else curses.A_NORMAL)
+        status = (f"q quit  up/down/PgUp/PgDn scroll  left/right devices  rows {self.offset + 1}-{min(longest, self.offset + visible_rows)} of {longest}"
+                  f"  devices {self.page + 1}-{min(len(self.keys), self.page + panes)} of {len(self.keys)}")
+        cells[(height - 1, 0)] = (status[:width - 1], curses.A_REVERSE)
+        return cells
+
+    def draw(self, screen):
+        height, width = screen.getmaxyx()
+        cells = self.frame(height, width)
+        for position, (text, _) in self.cells.items():
+            old_cell = cells.get(position)
+            if old_cell is None or len(old_cell[0]) < len(text):
+                # Blank what the new cell doesn't cover
+                screen.addstr(*position, ' ' * len(text))
+        for position, cell in cells.items():
+            if self.cells.get(position) != cell:
+                screen.addstr(*position, *cell)
+        self.cells = cells
+        screen.noutrefresh()
+        curses.doupdate()
+
+
+class RequestMetrics:
+    # Counters for every Modbus request the scanner makes: counts by function code and outcome
+    # ('ok', 'exception', 'timeout', 'error' or 'rejected' by an open circuit breaker), latency
+    # histograms per device and section, exception codes, bytes on the wire, and how long each scan
+    # phase took. Thread safe; read with snapshot(), or dump with to_json() / to_prometheus().
     def __init__(self):
-        self.local_ip = self.get_local_ip()
-        self.subnet_mask = self.get_subnet_mask()
-        self.network = self.get_network()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}  # (function code, outcome) -> count
+            self.latency = {}  # (device, section) -> [bucket counts..., +Inf count], sum
+            self.exception_codes = {}  # (function code, exception code) -> count
+            self.timeouts = {}  # device -> count
+            self.bytes_sent = {}  # device -> bytes
+            self.bytes_received = {}  # device -> bytes
+            self.phases = {}  # name -> [runs, total seconds]
+
+    def record(self, device, function_code, outcome, seconds, exception_code=None):
+        section = FUNCTION_SECTIONS.get(function_code, str(function_code))
+        with self.lock:
+            key = (function_code, outcome)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((device, section))
+            if histogram is None:
+                histogram = self.latency[(device, section)] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            if exception_code is not None:
+                key = (function_code, exception_code)
+                self.exception_codes[key] = self.exception_codes.get(key, 0) + 1
+            if outcome == 'timeout':
+                self.timeouts[device] = self.timeouts.get(device, 0) + 1
+
+    def record_bytes(self, device, sent=0, received=0):
+        with self.lock:
+            self.bytes_sent[device] = self.bytes_sent.get(device, 0) + sent
+            self.bytes_received[device] = self.bytes_received.get(device, 0) + received
+
+    def record_response(self, device, function_code, response, seconds):
+        if isinstance(response, modbus_exceptions.ModbusIOException):
+            self.record(device, function_code, 'timeout', seconds)
+        elif response.function_code & 0x80:
+            self.record(device, function_code, 'exception', seconds, response.exception_code)
+        else:
+            self.record(device, function_code, 'ok', seconds)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                runs = self.phases.setdefault(name, [0, 0.0])
+                runs[0] += 1
+                runs[1] += elapsed
+
+    def instrument(self, client, device):
+        # Wraps a ModbusTcpClient's execute, send and recv so every request it makes is recorded
+        execute, send, recv = client.execute, client.send, client.recv
+
+        def timed_execute(request):
+            start = time.perf_counter()
+            try:
+                response = execute(request)
+            except modbus_exceptions.ModbusIOException:
+                self.record(device, request.function_code, 'timeout', time.perf_counter() - start)
+                raise
+            except (modbus_exceptions.ModbusException, OSError):
+                self.record(device, request.function_code, 'error', time.perf_counter() - start)
+                raise
+            self.record_response(device, request.function_code, response, time.perf_counter() - start)
+            return response
+
+        def counted_send(data):
+            sent = send(data)
+            self.record_bytes(device, sent=sent or 0)
+            return sent
+
+        def counted_recv(size):
+            data = recv(size)
+            self.record_bytes(device, received=len(data or b''))
+            return data
+
+        client.execute, client.send, client.recv = timed_execute, counted_send, counted_recv
+        return client
+
+    def merge(self, snapshot):
+        # Adds a snapshot() taken elsewhere, e.g. in a scan worker process, into these totals
+        with self.lock:
+            for entry in snapshot['requests']:
+                key = (entry['function_code'], entry['outcome'])
+                self.requests[key] = self.requests.get(key, 0) + entry['count']
+            for entry in snapshot['latency']:
+                histogram = self.latency.setdefault((entry['device'], entry['section']), [[0] * (len(LATENCY_BUCKETS) + 1), 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], entry['buckets'])]
+                histogram[1] += entry['sum']
+            for entry in snapshot['exception_codes']:
+                key = (entry['function_code'], entry['exception_code'])
+                self.exception_codes[key] = self.exception_codes.get(key, 0) + entry['count']
+            for name in ('timeouts', 'bytes_sent', 'bytes_received'):
+                totals = getattr(self, name)
+                for device, count in snapshot[name].items():
+                    totals[device] = totals.get(device, 0) + count
+            for name, phase in snapshot['phases'].items():
+                runs = self.phases.setdefault(name, [0, 0.0])
+                runs[0] += phase['runs']
+                runs[1] += phase['seconds']
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': [{'function_code': function_code, 'outcome': outcome, 'count': count}
+                             for (function_code, outcome), count in sorted(self.requests.items())],
+                'latency': [{'device': device, 'section': section, 'buckets': list(buckets), 'sum': total, 'count': sum(buckets)}
+                            for (device, section), (buckets, total) in sorted(self.latency.items())],
+                'latency_buckets': list(LATENCY_BUCKETS),
+                'exception_codes': [{'function_code': function_code, 'exception_code': code, 'count': count}
+                                    for (function_code, code), count in sorted(self.exception_codes.items())],
+                'timeouts': dict(self.timeouts),
+                'bytes_sent': dict(self.bytes_sent),
+                'bytes_received': dict(self.bytes_received),
+                'phases': {name: {'runs': runs, 'seconds': seconds} for name, (runs, seconds) in self.phases.items()}
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ['# TYPE plcframework_requests_total counter']
+        for entry in snapshot['requests']:
+            lines.append(f'plcframework_requests_total{{function_code="{entry["function_code"]}",outcome="{entry["outcome"]}"}} {entry["count"]}')
+        lines.append('# TYPE plcframework_request_duration_seconds histogram')
+        for entry in snapshot['latency']:
+            labels = f'device="{entry["device"]}",section="{entry["section"]}"'
+            cumulative = 0
+            for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], entry['buckets']):
+                cumulative += count
+                lines.append(f'plcframework_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'plcframework_request_duration_seconds_sum{{{labels}}} {entry["sum"]}')
+            lines.append(f'plcframework_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+        lines.append('# TYPE plcframework_exception_responses_total counter')
+        for entry in snapshot['exception_codes']:
+            lines.append(f'plcframework_exception_responses_total{{function_code="{entry["function_code"]}",exception_code="{entry["exception_code"]}"}} {entry["count"]}')
+        for name in ('timeouts', 'bytes_sent', 'bytes_received'):
+            lines.append(f'# TYPE plcframework_{name}_total counter')
+            for device, count in sorted(snapshot[name].items()):
+                lines.append(f'plcframework_{name}_total{{device="{device}"}} {count}')
+        lines.append('# TYPE plcframework_phase_seconds_total counter')
+        for name, phase in sorted(snapshot['phases'].items()):
+            lines.append(f'plcframework_phase_seconds_total{{phase="{name}"}} {phase["seconds"]}')
+        lines.append('# TYPE plcframework_phase_runs_total counter')
+        for name, phase in sorted(snapshot['phases'].items()):
+            lines.append(f'plcframework_phase_runs_total{{phase="{name}"}} {phase["runs"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # Prometheus text format for a .prom path, JSON otherwise
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+class DevicePolicy:
+    # Adaptive timeout, retry and circuit breaker state for one device, or one unit behind a gateway.
+    # The timeout tracks the smoothed round trip time like TCP's retransmission timer (RFC 6298):
+    # srtt + 4 * rttvar, at least rtt_multiplier * srtt, within [min_timeout, max_timeout], and
+    # doubled after each timeout until a reply arrives. The floor keeps a PLC's occasional slow scan
+    # cycle from being mistaken for a lost request on a fast LAN. Timed out requests are retried after an
+    # exponential backoff. A device that has never answered keeps the configured timeout and gets no
+    # retries, as it is most likely not there at all. After failure_threshold consecutive failures the
+    # breaker opens and requests fail fast for open_seconds, then a single trial request is let through.
+    def __init__(self, timeout=3, min_timeout=0.5, max_timeout=30, rtt_multiplier=4, retries=2, backoff=0.1,
+                 max_backoff=2, failure_threshold=5, open_seconds=30):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.rtt_multiplier = rtt_multiplier
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.timeout = timeout  # Starts at the configured timeout until the first reply is measured
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0  # Consecutive failures
+        self.opened_at = None  # When the breaker last opened, or let a trial request through
+        self.lock = threading.Lock()
+
+    def observe(self, rtt):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            timeout = max(self.srtt + 4 * self.rttvar, self.rtt_multiplier * self.srtt)
+            self.timeout = min(self.max_timeout, max(self.min_timeout, timeout))
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, timed_out=True):
+        with self.lock:
+            self.failures += 1
+            if timed_out and self.srtt is not None:
+                self.timeout = min(self.max_timeout, self.timeout * 2)
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.open_seconds:
+                self.opened_at = time.monotonic()  # Half open, the next trial waits another open_seconds
+                return True
+            return False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    @property
+    def retry_budget(self):
+        # Retries only pay off once the device has answered; until then leave dead hosts to the breaker
+        return self.retries if self.srtt is not None else 0
+
+    def backoff_delay(self, attempt):
+        # Full jitter keeps many workers retrying one device from lining up
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+UNIT_HELPERS = ('read_coils', 'read_discrete_inputs', 'read_holding_registers', 'read_input_registers',
+                'write_coil', 'write_register', 'write_coils', 'write_registers')
+
+
+class UnitClient:
+    # One unit's view of a connection shared by every unit behind a gateway: the read and write
+    # helpers are addressed at the unit, everything else goes straight to the shared client
+    def __init__(self, client, unit):
+        self.client = client
+        self.unit = unit
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name in UNIT_HELPERS:
+            return partial(attr, slave=self.unit)
+        return attr
+
+
+def is_pipelined(client):
+    if isinstance(client, UnitClient):
+        client = client.client
+    return isinstance(client, PipelinedModbusClient)
+
+
+class ConnectionPool:
+    def __init__(self, timeout=3, idle_timeout=60, pipeline_depth=1, metrics=None):
+        self.timeout = timeout
+        self.metrics = metrics  # RequestMetrics every pooled client records into, None to skip
+        self.adaptive = True  # Give each device a DevicePolicy, False for a fixed timeout and no retries
+        self.policy_settings = {}  # Extra DevicePolicy arguments, e.g. {'retries': 3, 'open_seconds': 60}
+        self.policies = {}  # (ip, port, unit) -> DevicePolicy, so each unit behind a gateway has its own breaker
+        self.pipeline_depth = pipeline_depth  # Requests in flight per socket, above 1 uses PipelinedModbusClient
+        self.idle_timeout = idle_timeout  # Seconds a connection may sit unused before it is closed
+        self.connections = {}  # (ip, port) -> {'client', 'lock', 'last_used'}, shared by every unit behind it
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def borrow(self, ip, port=502, unit=None):
+        # unit None talks to the device the way a plain client does; set it to address one unit behind a gateway.
+        # All units share the gateway's connection, most gateways only accept a few sockets.
+        key = (ip, port)
+        with self.lock:
+            self.evict_idle()
+            entry = self.connections.get(key)
+            if entry is None:
+                entry = {'client': self.create_client(ip, port), 'lock': threading.RLock(), 'last_used': 0, 'borrowers': 0}
+                self.connections[key] = entry
+            entry['borrowers'] += 1
+        # The sync client isn't thread safe, so one borrower at a time per device. The lock is
+        # reentrant so nested helpers on the same thread share the socket instead of opening another.
+        with entry['lock']:
+            client = entry['client']
+            if not self.is_healthy(client):
+                self.reconnect(client)
+            try:
+                yield client if unit is None else UnitClient(client, unit)
+            except (modbus_exceptions.ConnectionException, OSError):
+                # Drop the broken socket, the next borrow reconnects
+                client.close()
+                raise
+            finally:
+                with self.lock:
+                    entry['last_used'] = time.monotonic()
+                    entry['borrowers'] -= 1
+
+    def policy(self, ip, port=502, unit=0):
+        with self.lock:
+            policy = self.policies.get((ip, port, unit))
+            if policy is None:
+                policy = self.policies[(ip, port, unit)] = DevicePolicy(self.timeout, **self.policy_settings)
+            return policy
+
+    def guard(self, client, ip, port):
+        # Wraps a ModbusTcpClient's execute so each request uses its unit's adaptive timeout, is retried
+        # on timeouts and is refused while that unit's breaker is open
+        execute = client.execute
+        device = f"{ip}:{port}"
+
+        def guarded_execute(request):
+            policy = self.policy(ip, port, request.unit_id)
+            response = None
+            retries = policy.retry_budget
+            for attempt in range(retries + 1):
+                if not policy.allow():
+                    if self.metrics is not None:
+                        self.metrics.record(device, request.function_code, 'rejected', 0.0)
+                    raise modbus_exceptions.ConnectionException(f"{device} unit {request.unit_id} skipped, circuit open after {policy.failures} consecutive failures")
+                client.params.timeout = policy.timeout
+                if client.socket is not None:
+                    client.socket.settimeout(policy.timeout)
+                start = time.monotonic()
+                try:
+                    response = execute(request)
+                except modbus_exceptions.ModbusIOException as e:
+                    response = e
+                except (modbus_exceptions.ConnectionException, OSError):
+                    policy.record_failure(timed_out=False)
+                    raise
+                if not isinstance(response, modbus_exceptions.ModbusIOException):
+                    policy.observe(time.monotonic() - start)
+                    return response
+                policy.record_failure()
+                client.close()  # A late reply would otherwise be read as the answer to the next request
+                if attempt < retries:
+                    time.sleep(policy.backoff_delay(attempt))
+            return response
+
+        client.execute = guarded_execute
+        return client
+
+    def create_client(self, ip, port):
+        # Called with self.lock held, so the policies are looked up per request rather than here
+        policies = partial(self.policy, ip, port) if self.adaptive else None
+        if self.pipeline_depth > 1:
+            return PipelinedModbusClient(ip, port=port, window=self.pipeline_depth, timeout=self.timeout,
+                                         metrics=self.metrics, policies=policies)
+        client = modbus_client.ModbusTcpClient(ip, port=port, timeout=self.timeout)
+        if self.metrics is not None:
+            self.metrics.instrument(client, f"{ip}:{port}")
+        if policies is not None:
+            self.guard(client, ip, port)
+        return client
+
+    def is_healthy(self, client):
+        # is_socket_open() only checks that a socket object exists, so peek at it: an empty read means
+        # the PLC closed it while it sat idle, and bytes waiting before any request was sent are a late
+        # reply that would be taken as the answer to the next one
+        sock = client.socket
+        if sock is None:
+            return False
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(timeout)
+        return False
+
+    def reconnect(self, client):
+        client.close()
+        if client.connect():
+            client.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def set_timeout(self, timeout):
+        # New connections and policies start from the new timeout, idle connections are closed so none keeps the old one
+        with self.lock:
+            self.timeout = timeout
+            self.policies.clear()
+        self.close_idle()
+
+    def close_idle(self):
+        # Closes every connection nobody is using, e.g. once a scan or poll is done with them, so an idle
+        # session doesn't hold a socket to every device it has talked to
+        with self.lock:
+            for key, entry in list(self.connections.items()):
+                if entry['borrowers'] == 0:
+                    entry['client'].close()
+                    del self.connections[key]
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for key, entry in list(self.connections.items()):
+            if entry['borrowers'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                entry['client'].close()
+                del self.connections[key]
+
+    def close_all(self):
+        with self.lock:
+            for entry in self.connections.values():
+                with entry['lock']:
+                    entry['client'].close()
+            self.connections.clear()
+
+
+# Where exploit-db's files_exploits.csv is usually found, after the directory searchsploit itself lives in
+EXPLOITDB_PATHS = ['/usr/share/exploitdb/files_exploits.csv', '/opt/exploitdb/files_exploits.csv',
+                   os.path.join(os.path.expanduser('~'), 'exploitdb', 'files_exploits.csv')]
+
+# Words in vendor names that say nothing about the vendor and would match unrelated exploits
+VENDOR_STOPWORDS = {'inc', 'ltd', 'llc', 'co', 'corp', 'corporation', 'company', 'gmbh', 'ag', 'sa', 'srl', 'bv', 'plc', 'the', 'and'}
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+(?:\.[a-z0-9]+)*')
+
+
+def tokenize(text):
+    # "Schneider Electric Modicon M340 < 2.4" -> ['schneider', 'electric', 'modicon', 'm340', '2.4']
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class ExploitIndex:
+    # Token index over exploit-db's files_exploits.csv. Every word of every exploit title maps to the
+    # sorted rows holding it, so a lookup is a few set intersections instead of a searchsploit process
+    # re-reading the CSV. The index is built once and cached as JSON next to the scan cache, and rebuilt
+    # when the CSV changes.
+    def __init__(self, csv_path, cache_path=None):
+        self.csv_path = csv_path
+        self.cache_path = cache_path
+        self.exploits = []  # [id, file, title, date, platform, type] per row
+        self.tokens = {}  # token -> row numbers
+
+    @classmethod
+    def locate(cls):
+        searchsploit = shutil.which('searchsploit')
+        paths = list(EXPLOITDB_PATHS)
+        if searchsploit is not None:
+            paths.insert(0, os.path.join(os.path.dirname(os.path.realpath(searchsploit)), 'files_exploits.csv'))
+        for path in paths:
+            if os.path.exists(path):
+                return path
+        raise RuntimeError("exploit-db's files_exploits.csv not found, install exploitdb or pass its path")
+
+    def load(self):
+        stat = os.stat(self.csv_path)
+        source = {'path': os.path.abspath(self.csv_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    cached = json.load(f)
+                if cached['source'] == source:
+                    self.exploits = cached['exploits']
+                    self.tokens = cached['tokens']
+                    return self
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Ignoring unreadable exploit index {self.cache_path}: {e}")
+        self.build()
+        if self.cache_path is not None:
+            temporary_path = f"{self.cache_path}.tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump({'source': source, 'exploits': self.exploits, 'tokens': self.tokens}, f)
+            os.replace(temporary_path, self.cache_path)
+        return self
+
+    def build(self):
+        self.exploits = []
+        self.tokens = {}
+        with open(self.csv_path, newline='', encoding='utf-8', errors='replace') as f:
+            for row in csv.DictReader(f):
+                number = len(self.exploits)
+                title = row.get('description', '')
+                self.exploits.append([row.get('id'), row.get('file'), title, row.get('date_published', row.get('date')),
+                                      row.get('platform'), row.get('type')])
+                for token in set(tokenize(title)):
+                    self.tokens.setdefault(token, []).append(number)
+        logger.info(f"Indexed {len(self.exploits)} exploits from {self.csv_path}")
+
+    def search(self, terms):
+        # Rows whose title holds every token of terms, like searchsploit's default title search
+        tokens = set(tokenize(terms)) if isinstance(terms, str) else set(terms)
+        if not tokens:
+            return set()
+        postings = sorted((self.tokens.get(token, []) for token in tokens), key=len)
+        rows = set(postings[0])
+        for posting in postings[1:]:
+            rows.intersection_update(posting)
+            if not rows:
+                break
+        return rows
+
+    def match(self, vendor, product=None, revision=None):
+        # Exploits naming the vendor, best first: ones that also name the product, then the revision
+        vendor_tokens = [token for token in tokenize(vendor) if token not in VENDOR_STOPWORDS] or tokenize(vendor)
+        rows = self.search(vendor_tokens)
+        if not rows:
+            return []
+        product_tokens = set(tokenize(product)) - set(vendor_tokens) if product else set()
+        product_rows = self.search(product_tokens) & rows
+        revision_rows = set()
+        for token in tokenize(revision) if revision else []:
+            # "V1.0" and "v1.0" both match a title saying "1.0"
+            token = token.lstrip('v')
+            revision_rows.update(self.tokens.get(token, []), self.tokens.get(f"v{token}", []))
+        matches = []
+        for row in rows:
+            exploit_id, path, title, date, platform, exploit_type = self.exploits[row]
+            matches.append({'id': exploit_id, 'title': title, 'path': path, 'date': date, 'platform': platform, 'type': exploit_type,
+                            'product_match': row in product_rows, 'revision_match': row in revision_rows})
+        matches.sort(key=lambda match: (not match['product_match'], not match['revision_match'], match['title']))
+        return matches
+
+
+class ModbusScanner:
+    def __init__(self, network=None):
+        # network is any mix of CIDRs, addresses and ranges accepted by parse_targets. Without one, the
+        # subnet of every local IPv4 interface is scanned. The interfaces and scan cache are only looked
+        # up when something first needs them.
+        self._targets = parse_targets(network) if network is not None else None
+        self._cache = None
         self.clients = []
-        self.memory_map = {}
-        logger.info(f"Hostname: {socket.gethostname()}")
-        logger.info(f"Local IP: {self.local_ip}")
-        logger.info(f"Subnet Mask: {self.subnet_mask}")
-
-    def get_local_ip(self):
-        for interface in netifaces.interfaces():
-            addr = netifaces.ifaddresses(interface).get(netifaces.AF_INET)
-            if addr:
-                for link in addr:
-                    if link['addr'] != '127.0.0.1':
-                        return link['addr']
-
-    def get_subnet_mask(self):
-        gws = netifaces.gateways()
-        default_interface = gws['default'][netifaces.AF_INET][1]
-        return netifaces.ifaddresses(default_interface)[netifaces.AF_INET][0]['netmask']
-
-    def get_network(self):
-        ip_interface = ipaddress.IPv4Interface(f'{self.local_ip}/{self.subnet_mask}')
-        return ip_interface.network
+        self.sweep_backend = 'native'  # 'native' or 'nmap'
+        self.scan_ports = [502]
+        self.sweep_concurrency = 256  # Connects in flight during the port sweep
+        self.connect_timeout = 1.0  # Seconds to wait for a TCP connect during the sweep
+        self.modbus_port = 502  # Port Modbus requests are sent to
+        self.scan_concurrency = 32  # Hosts probed at the same time
+        self.host_scan_timeout = 60  # Seconds for a whole host (identification and memory read)
+        self.history_size = 3600  # Poll samples kept per device
+        self.history = {}  # ip -> PollHistory from the last poll of that device
+        self.capture_dir = None  # Directory to write a PollCapture file per polled device, None to keep polls in memory only
+        self.dashboard_fps = 10  # Frame rate cap of the live poll dashboard
+        self.sample_exporter = None  # Exporter of SAMPLE_FIELDS that the interactive poll also streams every sample to
+        self.change_exporter = None  # Exporter of CHANGE_FIELDS that the interactive poll streams only the changed values to
+        self.on_device = None  # Called with each Device as soon as it is scanned, e.g. to stream it to an exporter
+        self.deadbands = {}  # {section: {address: deadband}} applied when reporting register changes
+        self.change_detectors = {}  # ip -> ChangeDetector holding the last reported values
+        self.discover_memory = False  # Map the full 0-65535 range of each table instead of reading 0-99
+        self.discover_resolution = 1024  # Addresses between samples of invalid space when discovering, lower finds smaller ranges
+        self.cache_path = os.path.join(os.path.expanduser('~'), '.plcframework_cache.json')  # None disables the scan cache
+        self.cache_ttl = 24 * 60 * 60  # Seconds before a cached device is fully probed again
+        self.exploitdb_path = None  # exploit-db's files_exploits.csv, None to look in the usual install locations
+        self.exploit_index_path = os.path.join(os.path.expanduser('~'), '.plcframework_exploits.json')  # None rebuilds the index every run
+        self._exploit_index = None
+        self.metrics = RequestMetrics()  # Per-request counters and latencies, and scan phase durations
+        self.pool = ConnectionPool(timeout=3, metrics=self.metrics)  # Set pool.pipeline_depth above 1 to pipeline reads
+        self.unit_ids = None  # Unit IDs to probe behind each host, e.g. range(1, 248); None treats each host as one device
+        self.unit_probe_timeout = 0.5  # Seconds each unit ID probe waits for a reply
+        self.gateway_in_flight = 2  # Requests in flight to one gateway, so its serial side isn't flooded
+        self.scan_processes = 1  # Above 1, modbus_scan splits the network across this many worker processes
+        self.shard_prefix = 24  # Prefix length of the subnets handed to each worker process
+
+    @property
+    def targets(self):
+        # Sorted, non-overlapping (first, last) address ranges to sweep
+        if self._targets is None:
+            logger.info(f"Hostname: {socket.gethostname()}")
+            interfaces = self.get_interfaces()
+            for name, interface in interfaces:
+                logger.info(f"Interface {name}: {interface.ip} netmask {interface.netmask}")
+            self._targets = parse_targets([str(interface.network) for _, interface in interfaces])
+        return self._targets
+
+    @targets.setter
+    def targets(self, targets):
+        self._targets = parse_targets(targets)
+
+    @property
+    def host_timeout(self):
+        # Seconds per Modbus request, held by the pool so a change applies to every connection opened after it
+        return self.pool.timeout
+
+    @host_timeout.setter
+    def host_timeout(self, timeout):
+        self.pool.set_timeout(timeout)
+
+    @property
+    def cache(self):
+        # CACHE_PREFIX sized subnet -> {device key: device identity, role, ranges and port state}
+        if self._cache is None:
+            self._cache = self.load_cache()
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        self._cache = cache
+
+    def get_interfaces(self):
+        # (name, IPv4Interface) for every address on every interface, skipping loopback and link-local
+        interfaces = []
+        for name in netifaces.interfaces():
+            for link in netifaces.ifaddresses(name).get(netifaces.AF_INET, []):
+                interface = ipaddress.IPv4Interface(f"{link['addr']}/{link['netmask']}")
+                if not interface.ip.is_loopback and not interface.ip.is_link_local:
+                    interfaces.append((name, interface))
+        if not interfaces:
+            raise RuntimeError("No non-loopback IPv4 address found, pass a network to scan explicitly")
+        return interfaces
 
     def connect_scan(self):
+        with self.metrics.phase('sweep'):
+            if self.sweep_backend == 'nmap':
+                hosts = self.nmap_scan()
+            else:
+                hosts = asyncio.run(self.collect_hosts(self.sweep()))
+        return [ip for ip, _ in hosts]
+
+    def nmap_scan(self):
+        try:
+            import nmap
+        except ImportError:
+            raise RuntimeError("The nmap backend needs python-nmap and nmap installed")
+        ports = ','.join(str(port) for port in self.scan_ports)
         nm = nmap.PortScanner()
-        nm.scan(hosts=str(self.network), arguments='-p 502')
-        clients_with_port_502_open = [host for host in nm.all_hosts() if nm[host].has_tcp(502) and nm[host]['tcp'][502]['state'] == 'open']
-        return clients_with_port_502_open
-
-    def read_device_identification(self, ip):
-        client = ModbusTcpClient(ip)
-        client.connect()
-        request = ReadDeviceInformationRequest(unit=1)
-        result = client.execute(request)
-        client.close()
+        hosts = ' '.join(str(network) for first, last in self.targets for network in ipaddress.summarize_address_range(first, last))
+        nm.scan(hosts=hosts, arguments=f'-p {ports}')
+        hosts = []
+        for host in nm.all_hosts():
+            open_ports = [port for port in self.scan_ports if nm[host].has_tcp(port) and nm[host]['tcp'][port]['state'] == 'open']
+            if open_ports:
+                hosts.append((host, open_ports))
+        return hosts
+
+    async def collect_hosts(self, hosts):
+        return [host async for host in hosts]
+
+    async def check_port(self, ip, port):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    async def sweep(self, targets=None):
+        # Yields (ip, open ports) for hosts with any of self.scan_ports open as soon as they are found.
+        # Every target range is swept at once, sharing the sweep_concurrency budget.
+        addresses = iter_addresses(targets or self.targets)
+        found = asyncio.Queue()
+
+        async def worker():
+            # All workers share one iterator, so at most sweep_concurrency connects are in flight
+            for address in addresses:
+                ip = str(address)
+                open_ports = [port for port in self.scan_ports if await self.check_port(ip, port)]
+                if open_ports:
+                    await found.put((ip, open_ports))
+
+        workers = asyncio.gather(*(worker() for _ in range(self.sweep_concurrency)))
+        workers.add_done_callback(lambda _: found.put_nowait(None))
+        while (host := await found.get()) is not None:
+            yield host
+        await workers
+
+    async def stream_hosts(self):
+        # Hosts are probed while the sweep is still running, so the sweep phase overlaps the probing
+        with self.metrics.phase('sweep'):
+            if self.sweep_backend == 'nmap':
+                for host in await asyncio.to_thread(self.nmap_scan):
+                    yield host
+            else:
+                async for host in self.sweep():
+                    yield host
+
+    def load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring unreadable scan cache {self.cache_path}: {e}")
+            return {}
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        # Write to a temporary file first so a crash never leaves a half written cache
+        temporary_path = f"{self.cache_path}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(temporary_path, self.cache_path)
+
+    def cache_device(self, device, open_ports):
+        now = time.time()
+        device_info = None
+        if device.device_info is not None:
+            # Identification objects are bytes, kept as latin-1 text so they survive JSON unchanged
+            device_info = {str(key): value.decode('latin-1') if isinstance(value, bytes) else value for key, value in device.device_info.items()}
+        self.cache.setdefault(cache_network(device.ip), {})[device.key] = {
+            'device_info': device_info,
+            'role': device.role,
+            'ranges': self.memory_map_ranges(device.memory_map) if device.memory_map is not None else None,
+            'ports': sorted(open_ports),
+            'discover_memory': self.discover_memory,
+            'discover_resolution': self.discover_resolution if self.discover_memory else None,
+            'unit_ids': list(self.unit_ids) if self.unit_ids is not None else None,
+            'probed_at': now,
+            'last_seen': now
+        }
+
+    def cached_device(self, ip, open_ports, unit=None):
+        # Rebuilds a device from a fresh cache entry, reading values over the cached ranges only. Returns
+        # None when the entry is missing, stale, or the host's open ports or the scan settings it was
+        # probed with changed, so it gets a full probe.
+        entry = self.cache.get(cache_network(ip), {}).get(ip if unit is None else f"{ip}/{unit}")
+        if entry is None or time.time() - entry['probed_at'] > self.cache_ttl or entry['ports'] != sorted(open_ports):
+            return None
+        unit_ids = list(self.unit_ids) if self.unit_ids is not None else None
+        if entry.get('discover_memory') != self.discover_memory or entry.get('unit_ids') != unit_ids:
+            return None
+        if self.discover_memory and entry.get('discover_resolution') != self.discover_resolution:
+            return None
+        device_info = None
+        if entry['device_info'] is not None:
+            device_info = {int(key): value.encode('latin-1') if isinstance(value, str) else value for key, value in entry['device_info'].items()}
+        memory_map = None
+        if entry['ranges']:
+            failures = []
+            with self.pool.borrow(ip, self.modbus_port, unit) as client:
+                memory_map = self.read_modbus_memory(client, ranges=entry['ranges'], failures=failures)
+            if not memory_map or failures:
+                return None  # The layout no longer answers, probe it again
+        entry['last_seen'] = time.time()
+        return Device(ip, device_info, entry['role'], memory_map, unit)
+
+    def read_device_identification(self, ip, unit=None):
+        request = mei_message.ReadDeviceInformationRequest(unit=1 if unit is None else unit)
+        with self.pool.borrow(ip, self.modbus_port, unit) as client:
+            result = client.execute(request)
         if result and result.function_code < 0x80:
             return result.information
         else:
             return None
 
-    def read_modbus_memory(self, client, addresses=None):
+    def plan_reads(self, addresses, max_count):
+        # Merge sorted addresses into contiguous (start, count) blocks no larger than one PDU
+        blocks = []
+        for address in sorted(addresses):
+            if blocks and blocks[-1][0] + blocks[-1][1] == address and blocks[-1][1] < max_count:
+                blocks[-1][1] += 1
+            else:
+                blocks.append([address, 1])
+        return [(start, count) for start, count in blocks]
+
+    def read_values(self, read_func, section, start, count, response=None):
+        # Values at [start, start + count), or None if the device answered with an exception. A block
+        # that got no answer at all raises ModbusIOException.
+        if response is None:
+            response = read_func(start, count)
+        if not response.isError():
+            if section in ['coils', 'discrete_inputs']:
+                return response.bits[:count]
+            return response.registers[:count]
+        if not getattr(response, 'function_code', 0) & 0x80:
+            raise modbus_exceptions.ModbusIOException(f"No answer reading {count} {section} at {start}")
+        return None
+
+    def read_block(self, read_func, section, start, count, values, response=None, failures=None):
+        # A block the device rejects holds at least one invalid address. The rest of it is walked: an
+        # invalid address costs one single read and a valid run is grown from its first address by
+        # doubling then bisecting, which also finds the invalid address after it for free. n addresses
+        # cost about n reads at worst rather than the 2n - 1 of halving down to single addresses.
+        # failures, if given, collects (section, start, count) of blocks that got no answer; those
+        # aren't split, every piece would wait out the same timeout.
+        end = start + count
+        try:
+            data = self.read_values(read_func, section, start, count, response)
+            if data is not None:
+                for offset, value in enumerate(data):
+                    values[start + offset] = value
+            elif count > 1:
+                while start < end:
+                    run = self.read_values(read_func, section, start, 1)
+                    if run is None:
+                        start += 1
+                        continue
+                    good, bad = 1, None
+                    while bad is None and start + good < end:
+                        size = min(good * 2, end - start)
+                        longer = self.read_values(read_func, section, start, size)
+                        if longer is None:
+                            bad = size
+                        else:
+                            good, run = size, longer
+                    while bad is not None and bad - good > 1:
+                        middle = (good + bad) // 2
+                        longer = self.read_values(read_func, section, start, middle)
+                        if longer is None:
+                            bad = middle
+                        else:
+                            good, run = middle, longer
+                    for offset, value in enumerate(run):
+                        values[start + offset] = value
+                    start += good + 1  # Reading one past the run failed, so that address is invalid
+        except modbus_exceptions.ConnectionException:
+            raise  # The device is unreachable
+        except modbus_exceptions.ModbusException:
+            if failures is not None:
+                failures.append((section, start, end - start))
+
+    def probe_block(self, client, section, start, count):
+        try:
+            response = getattr(client, f'read_{section}')(start, count)
+            return not response.isError()
+        except modbus_exceptions.ConnectionException:
+            raise
+        except modbus_exceptions.ModbusException:
+            return False
+
+    def extend_down(self, client, section, low, address):
+        # Lowest address >= low where the valid run ending at `address` starts
+        max_count = MAX_READ_COUNT[section]
+        while True:
+            floor = max(low, address - max_count + 1)
+            first = address
+            while floor < first:
+                middle = (floor + first) // 2
+                if self.probe_block(client, section, middle, address + 1 - middle):
+                    first = middle
+                else:
+                    floor = middle + 1
+            if first == low or first > address - max_count + 1:
+                return first
+            address = first  # The run is longer than one PDU, keep going
+
+    def extend_up(self, client, section, address, high):
+        # Highest address <= high where the valid run starting at `address` ends
+        max_count = MAX_READ_COUNT[section]
+        while True:
+            ceiling = min(high, address + max_count - 1)
+            last = address
+            while last < ceiling:
+                middle = (last + ceiling + 1) // 2
+                if self.probe_block(client, section, address, middle + 1 - address):
+                    last = middle
+                else:
+                    ceiling = middle - 1
+            if last == high or last < address + max_count - 1:
+                return last
+            address = last
+
+    def probe_blocks(self, client, section, blocks):
+        # probe_block for many (start, count) blocks, sent back to back when the client pipelines
+        if is_pipelined(client):
+            requests = [modbus_request(READ_REQUESTS, section, address, count, unit=client.unit) for address, count in blocks]
+            return [not response.isError() for response in client.execute_many(requests)]
+        return [self.probe_block(client, section, address, count) for address, count in blocks]
+
+    def scan_gap(self, client, section, start, end, left_valid, right_valid, resolution, found):
+        # [start, end) holds at least one block that failed to read. Runs coming in from valid
+        # neighbours are followed to their ends, then the rest is sampled every `resolution`
+        # addresses in one batch and each hit is grown to its full extent by bisection.
+        if right_valid:
+            first = self.extend_down(client, section, start, end)
+            if first < end:
+                found.append((first, end - first))
+            end = first - 1
+        if left_valid:
+            last = self.extend_up(client, section, start - 1, end - 1)
+            if last >= start:
+                found.append((start, last + 1 - start))
+            start = last + 2
+        samples = list(range(start, end, resolution))
+        hits = {address for address, valid in zip(samples, self.probe_blocks(client, section, [(address, 1) for address in samples])) if valid}
+        low = start  # Everything below is mapped or known to be invalid
+        for address in samples:
+            if address < low:
+                continue
+            if address not in hits:
+                low = address + 1
+                continue
+            first = self.extend_down(client, section, low, address)
+            last = self.extend_up(client, section, address, end - 1)
+            found.append((first, last + 1 - first))
+            low = last + 2
+
+    def discover_address_ranges(self, client, sections=None, start=0, end=65536, resolution=1024):
+        # Map which addresses exist with PDU-sized probes instead of one read per address. Returns
+        # {section: [(start, count), ...]}. Inside space that fails the PDU-sized probes every
+        # `resolution`-th address is sampled, so every isolated range of at least `resolution`
+        # addresses is found; shorter ones between invalid space can still be missed. An empty table
+        # costs about 65536 / resolution single-address probes on top of the PDU-sized ones, pipelined
+        # when the client allows it, so the default stays coarse and finer sampling is opt-in.
+        ranges = {}
+        for section in sections or MAX_READ_COUNT:
+            max_count = MAX_READ_COUNT[section]
+            blocks = [(address, min(max_count, end - address)) for address in range(start, end, max_count)]
+            valid = self.probe_blocks(client, section, blocks)
+
+            found = [block for block, block_valid in zip(blocks, valid) if block_valid]
+            i = 0
+            while i < len(blocks):
+                if valid[i]:
+                    i += 1
+                    continue
+                # Treat each run of failing blocks as one gap
+                j = i
+                while j + 1 < len(blocks) and not valid[j + 1]:
+                    j += 1
+                gap_start, gap_end = blocks[i][0], blocks[j][0] + blocks[j][1]
+                left_valid = i > 0
+                right_valid = j + 1 < len(blocks)
+                self.scan_gap(client, section, gap_start, gap_end, left_valid, right_valid, resolution, found)
+                i = j + 1
+
+            # Merge adjacent pieces into one range each
+            merged = []
+            for address, count in sorted(found):
+                if merged and merged[-1][0] + merged[-1][1] == address:
+                    merged[-1] = (merged[-1][0], merged[-1][1] + count)
+                else:
+                    merged.append((address, count))
+            if merged:
+                ranges[section] = merged
+        return ranges
+
+    def memory_map_ranges(self, memory_map):
+        return {section: values.ranges() if isinstance(values, MemorySection) else address_ranges(sorted(values))
+                for section, values in memory_map.items()}
+
+    def read_modbus_memory(self, client, addresses=None, ranges=None, failures=None):
         sections = {
             'coils': {'start_address': 0, 'num_elements': 100, 'read_func': client.read_coils},
             'discrete_inputs': {'start_address': 0, 'num_elements': 100, 'read_func': client.read_discrete_inputs},
@@ -76,163 +1984,507 @@ class ModbusScanner:
             values = {}
 
             address_range = range(start_address, start_address + num_elements)
+            if ranges is not None:
+                # Read the given (start, count) ranges instead of the default window
+                address_range = [address for range_start, count in ranges.get(section, []) for address in range(range_start, range_start + count)]
             if addresses is not None:
                 address_range = [address for address in address_range if address in addresses]
 
-            for address in address_range:
-                try:
-                    response = read_func(address, 1)
-                    if not response.isError():
-                        if section in ['coils', 'discrete_inputs']:
-                            values[address] = response.bits[0]
-                        else:
-                            values[address] = response.registers[0]
-                except ModbusException:
-                    pass
+            blocks = self.plan_reads(address_range, MAX_READ_COUNT[section])
+            if is_pipelined(client):
+                # Send the first pass of every block back to back, only the splits go one at a time
+                requests = [modbus_request(READ_REQUESTS, section, start, count, unit=client.unit) for start, count in blocks]
+                for (start, count), response in zip(blocks, client.execute_many(requests)):
+                    self.read_block(read_func, section, start, count, values, response=response, failures=failures)
+            else:
+                for start, count in blocks:
+                    self.read_block(read_func, section, start, count, values, failures=failures)
 
             # Add the values for the section if no errors occurred
             if len(values) > 0:
-                memory_map[section] = values
+                memory_map[section] = dict(sorted(values.items()))
 
         return memory_map
 
-    def modbus_scan(self):
-        self.clients.clear()
-        clients = self.connect_scan()
-        for ip in clients:
+    def discover_units(self, ip):
+        # Asks each ID in unit_ids for one holding register over gateway_in_flight connections, one request
+        # outstanding on each, as gateways tend to drop requests queued behind one for a silent unit. Any
+        # reply counts, even an illegal address exception, except the gateway's own exceptions for a serial
+        # device that didn't answer. One ID from the reserved 248-254 range is asked too: a device that
+        # answers it ignores the unit ID, so [None] is returned and it is scanned as a single device.
+        sentinel = next((unit for unit in range(248, 255) if unit not in self.unit_ids), None)
+        unit_ids = list(self.unit_ids) + ([sentinel] if sentinel is not None else [])
+        connections = max(1, min(self.gateway_in_flight, len(unit_ids)))
+
+        def probe(units):
+            client = PipelinedModbusClient(ip, port=self.modbus_port, window=1, timeout=self.unit_probe_timeout, metrics=self.metrics)
             try:
-                client = ModbusTcpClient(ip)
-                client.connect()
-                device_info = self.read_device_identification(ip)
+                return client.execute_many([register_read_message.ReadHoldingRegistersRequest(0, 1, unit=unit) for unit in units])
+            finally:
+                client.close()
+
+        slices = [unit_ids[i::connections] for i in range(connections)]
+        responses = {}
+        try:
+            with self.metrics.phase('discover_units'), futures.ThreadPoolExecutor(max_workers=connections) as executor:
+                for units, results in zip(slices, executor.map(probe, slices)):
+                    responses.update(zip(units, results))
+        except modbus_exceptions.ConnectionException as e:
+            logger.error(f"Failed to probe unit IDs on {ip}: {e}")
+            return []
+        units = []
+        for unit in unit_ids:
+            response = responses[unit]
+            if isinstance(response, modbus_exceptions.ModbusIOException):
+                continue
+            if response.function_code & 0x80 and response.exception_code in GATEWAY_EXCEPTIONS:
+                continue
+            units.append(unit)
+        if sentinel in units:
+            return [None]
+        logger.info(f"{ip} answers on unit IDs {units}")
+        return units
+
+    def scan_host(self, ip, unit=None):
+        try:
+            with self.pool.borrow(ip, self.modbus_port, unit) as client:
+                with self.metrics.phase('device_identification'):
+                    device_info = self.read_device_identification(ip, unit)
                 memory_map = None
+                failures = []
                 try:
-                    memory_map = self.read_modbus_memory(client)
+                    ranges = None
+                    if self.discover_memory:
+                        with self.metrics.phase('discover'):
+                            ranges = self.discover_address_ranges(client, resolution=self.discover_resolution)
+                    with self.metrics.phase('read_memory'):
+                        memory_map = self.read_modbus_memory(client, ranges=ranges, failures=failures)
                     if memory_map:  # If there is a memory map, assume it's a server
-                        self.clients.append((ip, device_info, "Server", memory_map))
+                        return Device(ip, device_info, "Server", memory_map, unit, incomplete=bool(failures))
                     else:
-                        self.clients.append((ip, device_info, "Client", None))
-                except:
-                    self.clients.append((ip, device_info, "Client", None))
-                finally:
-                    client.close()
-            except Exception as e:
-                logger.exception(f"Failed to connect or read memory map for {ip}: {e}")
-                self.clients.append((ip, None, None, None))
+                        return Device(ip, device_info, "Client", unit=unit, incomplete=bool(failures))
+                except Exception as e:
+                    logger.error(f"Failed to read memory map for {ip}: {e}")
+                    return Device(ip, device_info, "Client", unit=unit, incomplete=True)
+        except Exception as e:
+            logger.exception(f"Failed to connect or read memory map for {ip}: {e}")
+            return Device(ip, unit=unit)
+
+    async def modbus_scan_async(self, hosts):
+        # Each host is probed on its own worker thread so one slow device can't stall the others
+        loop = asyncio.get_running_loop()
+        executor = futures.ThreadPoolExecutor(max_workers=self.scan_concurrency)
+        semaphore = asyncio.Semaphore(self.scan_concurrency)
+
+        def scan_unit(ip, open_ports, unit=None):
+            with self.metrics.phase('scan_host'):
+                try:
+                    device = self.cached_device(ip, open_ports, unit)
+                except Exception as e:
+                    logger.error(f"Failed to refresh cached device {ip}, probing it again: {e}")
+                    device = None
+                if device is None:
+                    device = self.scan_host(ip, unit)
+                    # Only cache what was read in full, so a device that timed out isn't remembered as a Client
+                    if device.role is not None and not device.incomplete:
+                        self.cache_device(device, open_ports)
+            return device
+
+        def scan(ip, open_ports):
+            if self.unit_ids is None:
+                return [scan_unit(ip, open_ports)]
+            units = self.discover_units(ip)
+            if not units:
+                return [Device(ip)]
+            # Each unit is its own device, read at most gateway_in_flight at a time
+            with futures.ThreadPoolExecutor(max_workers=self.gateway_in_flight) as unit_executor:
+                return list(unit_executor.map(lambda unit: scan_unit(ip, open_ports, unit), units))
+
+        async def probe(ip, open_ports):
+            async with semaphore:
+                try:
+                    result = await asyncio.wait_for(loop.run_in_executor(executor, scan, ip, open_ports), self.host_scan_timeout)
+                except asyncio.TimeoutError:
+                    logger.error(f"Timed out scanning {ip} after {self.host_scan_timeout} seconds")
+                    result = [Device(ip)]
+            self.clients.extend(result)
+            if self.on_device is not None:
+                for device in result:
+                    self.on_device(device)
+
+        try:
+            # Probing starts on the first host found while the sweep is still running
+            tasks = [asyncio.create_task(probe(ip, open_ports)) async for ip, open_ports in hosts]
+            await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=False)
+
+    def modbus_scan(self):
+        # Devices may come back with a different layout, so changes are tracked from the new scan on
+        self.change_detectors.clear()
+        if self.scan_processes > 1:
+            self.sharded_scan()
+            return
+        self.clients.clear()
+        if self._cache is None:
+            self._cache = self.load_cache()  # Before the scan workers start, or each would load its own copy
+        with self.metrics.phase('modbus_scan'):
+            asyncio.run(self.modbus_scan_async(self.stream_hosts()))
+        self.pool.close_idle()
+        self.save_cache()
+        # Keep the same order the serial scan produced
+        self.clients.sort(key=device_sort_key)
+
+    def sharded_scan(self, targets=None):
+        # Splits the targets into shard_prefix sized pieces and sweeps and probes them across a pool
+        # of scan_processes workers. The sweep and probe concurrency budgets are divided between the
+        # workers so the whole run stays within the same socket and file descriptor limits.
+        shards = split_ranges(parse_targets(targets) if targets else self.targets, self.shard_prefix)
+        processes = min(self.scan_processes, len(shards))
+        settings = {
+            'sweep_backend': self.sweep_backend,
+            'scan_ports': self.scan_ports,
+            'sweep_concurrency': max(1, self.sweep_concurrency // processes),
+            'connect_timeout': self.connect_timeout,
+            'modbus_port': self.modbus_port,
+            'scan_concurrency': max(1, self.scan_concurrency // processes),
+            'host_timeout': self.host_timeout,
+            'host_scan_timeout': self.host_scan_timeout,
+            'discover_memory': self.discover_memory,
+            'discover_resolution': self.discover_resolution,
+            'cache_ttl': self.cache_ttl,
+            'unit_ids': list(self.unit_ids) if self.unit_ids is not None else None,
+            'unit_probe_timeout': self.unit_probe_timeout,
+            'gateway_in_flight': self.gateway_in_flight,
+            'pipeline_depth': self.pool.pipeline_depth,
+            'adaptive': self.pool.adaptive,
+            'policy_settings': self.pool.policy_settings
+        }
+
+        self.clients.clear()
+        with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            shard_futures = []
+            for first, last in shards:
+                shard_cache = {}
+                for network in {cache_network(piece) for piece, _ in split_ranges([(first, last)], CACHE_PREFIX)}:
+                    shard_cache[network] = {key: entry for key, entry in self.cache.get(network, {}).items()
+                                            if first <= ipaddress.IPv4Address(parse_device_key(key)[0]) <= last}
+                shard_futures.append(executor.submit(scan_shard, format_range(first, last), settings, shard_cache))
+            for future in futures.as_completed(shard_futures):
+                try:
+                    devices, shard_cache, shard_metrics = future.result()
+                except Exception as e:
+                    logger.exception(f"Scan worker failed: {e}")
+                    continue
+                self.clients.extend(devices)
+                if self.on_device is not None:
+                    for device in devices:
+                        self.on_device(device)
+                for network, entries in shard_cache.items():
+                    self.cache.setdefault(network, {}).update(entries)
+                self.metrics.merge(shard_metrics)
+        self.save_cache()
+        self.clients.sort(key=device_sort_key)
 
     def print_clients(self, re_read_memory=False):
         for i, client in enumerate(self.clients, 1):
             ip, device_info, role, memory_map = client
             if re_read_memory and role == "Server" and memory_map is not None:
-                new_client = ModbusTcpClient(ip)
-                new_client.connect()
                 try:
-                    valid_addresses = set(address for section in memory_map.values() for address in section.keys())
-                    new_memory_map = self.read_modbus_memory(new_client, addresses=valid_addresses)
-                    self.clients[i-1] = (ip, device_info, role, new_memory_map)
+                    with self.pool.borrow(ip, self.modbus_port, client.unit) as new_client:
+                        new_memory_map = self.read_modbus_memory(new_client, ranges=self.memory_map_ranges(memory_map))
+                    # The memory map takes the whole read, the detector only decides which changes are logged
+                    events = self.detect_changes(client.key, memory_map, new_memory_map)
+                    for section, values in new_memory_map.items():
+                        merged = dict(memory_map[section]) if section in memory_map else {}
+                        merged.update(values)
+                        memory_map[section] = MemorySection.from_dict(section, merged)
+                    for section, address, old, new, _ in events:
+                        logger.info(f"{client.key} {section} address {address} changed: {old} -> {new}")
                 except Exception as e:
-                    logger.exception(f"Failed to re-read memory map for {ip}: {e}")
-                finally:
-                    new_client.close()
-            logger.info(f"{i}. {ip} - Device Info: {device_info} - Role: {role}")
-
-    def write_modbus_memory(self, client, section_name, address, value):
-        sections = [
-            ("Coil", client.write_coil),
-            ("Holding Register", client.write_register),
-        ]
-        for valid_section_name, write_func in sections:
-            if valid_section_name == section_name:
+                    logger.exception(f"Failed to re-read memory map for {client.key}: {e}")
+            logger.info(f"{i}. {client.key} - Device Info: {device_info} - Role: {role}")
+        if re_read_memory:
+            self.pool.close_idle()
+
+    def write_modbus_memory(self, client, section_name, address, value, memory_map=None):
+        if section_name not in WRITE_SECTIONS:
+            logger.error(f"Invalid section name: {section_name}")
+            return False
+        return not self.write_batch(client, [(section_name, address, value)], memory_map)
+
+    def plan_writes(self, values, max_count):
+        # Split {address: value} into runs of consecutive addresses, each small enough for one request
+        runs = []
+        for address in sorted(values):
+            if runs and runs[-1][0] + len(runs[-1][1]) == address and len(runs[-1][1]) < max_count:
+                runs[-1][1].append(values[address])
+            else:
+                runs.append((address, [values[address]]))
+        return runs
+
+    def write_batch(self, client, changes, memory_map=None):
+        # Writes many (section, address, value) changes. Adjacent addresses go out as one function code
+        # 15/16 request, then each section is read back with coalesced block reads to check the values
+        # landed and to update memory_map in place. Returns the changes that failed as
+        # (section, address, value, reason); an empty list means everything was written and verified.
+        pending = {}
+        failures = []
+        for section_name, address, value in changes:
+            section = WRITE_SECTIONS.get(section_name)
+            if section is None:
+                logger.error(f"Invalid section name: {section_name}")
+                failures.append((section_name, address, value, "invalid section"))
+                continue
+            if not 0 <= address <= 65535:
+                failures.append((section_name, address, value, "address out of range 0-65535"))
+                continue
+            if section == 'coils' and value not in (0, 1):
+                failures.append((section_name, address, value, "coil value must be 0 or 1"))
+                continue
+            if section == 'holding_registers' and not 0 <= value <= 65535:
+                failures.append((section_name, address, value, "register value out of range 0-65535"))
+                continue
+            pending.setdefault(section, {})[address] = value  # A later change to the same address wins
+
+        requests = []
+        for section, values in pending.items():
+            for start, run in self.plan_writes(values, MAX_WRITE_COUNT[section]):
+                if len(run) == 1:
+                    request = modbus_request(WRITE_SINGLE_REQUESTS, section, start, run[0], unit=getattr(client, 'unit', 1))
+                else:
+                    request = modbus_request(WRITE_MULTIPLE_REQUESTS, section, start, run, unit=getattr(client, 'unit', 1))
+                requests.append((section, start, run, request))
+
+        with self.metrics.phase('write'):
+            if is_pipelined(client):
+                responses = client.execute_many([request for _, _, _, request in requests])
+            else:
+                responses = []
+                for section, start, run, _ in requests:
+                    try:
+                        if len(run) == 1:
+                            responses.append(getattr(client, WRITE_SINGLE_METHODS[section])(start, run[0]))
+                        else:
+                            responses.append(getattr(client, WRITE_MULTIPLE_METHODS[section])(start, run))
+                    except modbus_exceptions.ModbusException as e:
+                        responses.append(e)
+
+        for (section, start, run, _), response in zip(requests, responses):
+            if response.isError():
+                logger.error(f"Failed to write {len(run)} {section} at address {start}: {response}")
+                for offset, value in enumerate(run):
+                    failures.append((section, start + offset, value, str(response)))
+                    del pending[section][start + offset]
+
+        # Read back everything that was accepted, one coalesced pass per section
+        for section, values in pending.items():
+            actual = {}
+            read_func = getattr(client, f'read_{section}')
+            with self.metrics.phase('verify'):
+                for start, count in self.plan_reads(values, MAX_READ_COUNT[section]):
+                    self.read_block(read_func, section, start, count, actual)
+            for address, value in values.items():
+                if address not in actual:
+                    failures.append((section, address, value, "read back failed"))
+                    continue
+                if int(actual[address]) != int(value):
+                    failures.append((section, address, value, f"read back {int(actual[address])}"))
+                if memory_map is not None and address in memory_map.get(section, {}):
+                    memory_map[section][address] = actual[address]
+        return failures
+
+    def load_write_recipe(self, path):
+        # A recipe is a CSV file of section,address,value rows, e.g. "holding_registers,40,1200"
+        changes = []
+        with open(path, newline='') as f:
+            for line, row in enumerate(csv.reader(f), 1):
+                if not row or row[0].startswith('#'):
+                    continue
                 try:
-                    response = write_func(address, value)
-                    if isinstance(response, ModbusException):
-                        logger.exception(f"Failed to write to {section_name} at address {address}: {response}")
-                        return False
-                    else:
-                        self.update_memory_map(client, section_name, address)
-                        return True
-                except ModbusException as e:
-                    logger.exception(f"Failed to write to {section_name} at address {address}: {e}")
-                    return False
-        logger.error(f"Invalid section name: {section_name}")
-        return False
-    
-    def update_memory_map(self, client, section_name, address):
-        sections = {
-            'coils': {'start_address': 0, 'num_elements': 100, 'read_func': client.read_coils},
-            'holding_registers': {'start_address': 0, 'num_elements': 100, 'read_func': client.read_holding_registers}
-        }
-        config = sections.get(section_name)
-        if config is None:
-            return
-        read_func = config['read_func']
+                    section_name, address, value = (field.strip() for field in row)
+                    changes.append((section_name, int(address), int(value)))
+                except ValueError:
+                    raise ValueError(f"line {line} isn't section,address,value: {','.join(row)}")
+        return changes
+
+    def detect_changes(self, ip, memory_map, new_memory_map):
+        detector = self.change_detectors.get(ip)
+        if detector is None:
+            detector = self.change_detectors[ip] = ChangeDetector(memory_map, self.deadbands)
+        return detector.update(new_memory_map)
+
+    def poll_devices(self, ips, polling_rate, polling_amount=None, on_poll=None, on_change=None, stop=None):
+        # Polls every device on its own thread and fixed-deadline schedule. on_poll(ip, poll_num, memory_map)
+        # is called with each result and on_change(ip, events) with the changes found in it, if any.
+        # Runs until polling_amount polls (None for no limit), Ctrl+C or the stop event is set. Units
+        # behind a gateway are given by their device key, "ip/unit".
+        stop = stop or threading.Event()
+        memory_maps = {client.key: client.memory_map for client in self.clients}
+        ranges = {ip: self.memory_map_ranges(memory_maps[ip]) for ip in ips}
+        schedulers = {ip: PollScheduler(polling_rate, polling_amount) for ip in ips}
+
+        def poll(ip, poll_num):
+            memory_map = memory_maps[ip]
+            try:
+                host, unit = parse_device_key(ip)
+                with self.metrics.phase('poll'), self.pool.borrow(host, self.modbus_port, unit) as client:
+                    new_memory_map = self.read_modbus_memory(client, ranges=ranges[ip])
+                # Converted to arrays once, the history, captures and change detection all work on them
+                new_memory_map = compact_memory_map(new_memory_map)
+            except Exception as e:
+                logger.exception(f"Failed to poll {ip}: {e}")
+                new_memory_map = {}
+            if on_poll is not None:
+                on_poll(ip, poll_num, new_memory_map)
+            if on_change is not None:
+                events = self.detect_changes(ip, memory_map, new_memory_map)
+                if events:
+                    on_change(ip, events)
+
+        threads = [threading.Thread(target=scheduler.run, args=(lambda poll_num, ip=ip: poll(ip, poll_num),), daemon=True)
+                   for ip, scheduler in schedulers.items()]
+        for thread in threads:
+            thread.start()
         try:
-            response = read_func(address, 1)
-            if not response.isError():
-                if section_name == 'Coil':
-                    self.memory_map[section_name][address] = response.bits[0]
-                else:
-                    self.memory_map[section_name][address] = response.registers[0]
-        except ModbusException:
+            while any(thread.is_alive() for thread in threads) and not stop.wait(0.5):
+                pass
+        except KeyboardInterrupt:
             pass
+        for scheduler in schedulers.values():
+            scheduler.stop()
+        for thread in threads:
+            thread.join()
+        self.pool.close_idle()
+        return {ip: scheduler.stats() for ip, scheduler in schedulers.items()}
 
-    
     def poll_device(self):
         self.print_clients()
-        selected = input("Select a device (or 'back' to go back): ")
+        selected = input("Select devices separated by commas (or 'back' to go back): ")
         if selected.lower() == 'back':
             return
-        selected = int(selected) - 1
-        if selected >= len(self.clients):
+        selected = [int(device) - 1 for device in selected.split(',')]
+        if any(device >= len(self.clients) for device in selected):
             print("Invalid device. Please try again.")
             return
-        polling_rate = int(input("Enter polling rate in seconds: "))
-        polling_amount = min(20, int(input("Enter amount of polls (max 20): ")))
+        try:
+            polling_rate = float(input("Enter polling rate in seconds: "))
+            if not polling_rate > 0:
+                raise ValueError
+            polling_amount = int(input("Enter amount of polls (0 to poll until Ctrl+C): ")) or None
+        except ValueError:
+            print("Invalid polling rate or amount. Please try again.")
+            return
 
-        _, _, _, memory_map = self.clients[selected]
-        if memory_map is None:
+        devices = {self.clients[device].key: self.clients[device].memory_map for device in selected}
+        if any(memory_map is None for memory_map in devices.values()):
             print("This client doesn't have a memory map.")
             return
-        client = ModbusTcpClient(self.clients[selected][0])
-        client.connect()
-
-        # Initialize table with initial memory map values
-        table = {}
-        for section_name, section in memory_map.items():
-            table[section_name] = np.zeros((len(section), polling_amount + 2), dtype=int)
-            for i, (address, value) in enumerate(section.items()):
-                table[section_name][i, 0] = address
-                table[section_name][i, 1] = value
-
-        valid_addresses = set(address for section in memory_map.values() for address in section.keys())
-
-        # Poll the device and update the table
-        for poll_num in range(polling_amount):
-            time.sleep(polling_rate)
-            new_memory_map = self.read_modbus_memory(client, addresses=valid_addresses)
-            for section_name in table:
-                new_section = new_memory_map.get(section_name, {})
-                for i, address in enumerate(table[section_name][:, 0]):
-                    table[section_name][i, poll_num + 2] = new_section.get(address, 0)
 
-        client.close()
+        captures = {}
+        for ip, memory_map in devices.items():
+            self.history[ip] = PollHistory(memory_map, self.history_size)
+            if self.capture_dir is not None:
+                path = os.path.join(self.capture_dir, f"{ip.replace('/', '-')}-{time.strftime('%Y%m%d-%H%M%S')}.cap")
+                captures[ip] = PollCapture(path, memory_map)
+                logger.info(f"Capturing polls of {ip} to {path}")
+
+        dashboard = PollDashboard(devices, self.dashboard_fps) if sys.stdout.isatty() else None
+
+        def record(ip, poll_num, new_memory_map):
+            timestamp = time.time()
+            self.history[ip].append(new_memory_map, timestamp)
+            if ip in captures:
+                captures[ip].append(new_memory_map, timestamp)
+            if self.sample_exporter is not None:
+                self.sample_exporter.write(sample_rows(ip, poll_num + 1, timestamp, new_memory_map))
+            if dashboard is not None:
+                dashboard.update(ip, poll_num, new_memory_map, timestamp)
 
-        # Print the table
-        for section_name, section_table in table.items():
-            ptable = PrettyTable()
-            ptable.title = section_name
-            ptable.field_names = ["Memory Address", "Initial Value"] + [f"{i+1}st Poll Value" for i in range(polling_amount)]
-            for row in section_table:
-                ptable.add_row(row)
-            print(ptable)
+        changes = {ip: 0 for ip in devices}
+
+        def count_changes(ip, events):
+            changes[ip] += len(events)
+            if self.change_exporter is not None:
+                self.change_exporter.write(change_rows(ip, events))
+            if dashboard is not None:
+                dashboard.mark_changes(ip, events)
 
-    def searchsploit(self, vendor_name):
         try:
-            result = subprocess.run(['searchsploit', vendor_name], capture_output=True, text=True)
-            return result.stdout
-        except Exception as e:
-            print(f"An error occurred while running searchsploit: {e}")
+            stats = self.poll_with_dashboard(dashboard, list(devices), polling_rate, polling_amount, record, count_changes)
+        finally:
+            for capture in captures.values():
+                capture.close()
+
+        for ip, memory_map in devices.items():
+            if dashboard is None:
+                self.print_poll_summary(ip, memory_map)
+            device_stats = stats[ip]
+            logger.info(f"{ip}: {device_stats['polls']} polls, mean period {device_stats['mean_period']:.4f}s, "
+                        f"jitter {device_stats['jitter'] * 1000:.2f}ms, max lateness {device_stats['max_lateness'] * 1000:.2f}ms, "
+                        f"{device_stats['overruns']} overruns ({device_stats['skipped']} polls skipped), {changes[ip]} value changes")
+
+    def print_poll_summary(self, ip, memory_map):
+        # Plain text view of a finished poll for when there is no terminal to draw the dashboard on:
+        # one row per address with its value before polling, the latest poll and the range seen
+        history = self.history[ip]
+        print(f"{ip}: {len(history)} polls")
+        for section, initial in memory_map.items():
+            _, values = history.window(section)
+            if len(values) == 0:
+                continue
+            print(f"  {section}")
+            print(f"    {'address':>7} {'initial':>7} {'latest':>7} {'min':>7} {'max':>7} {'mean':>9}")
+            rows = zip(history.addresses[section].tolist(), values[-1].tolist(), values.min(axis=0).tolist(),
+                       values.max(axis=0).tolist(), values.mean(axis=0).tolist())
+            for address, latest, minimum, maximum, mean in rows:
+                print(f"    {address:>7} {int(initial.get(address, 0)):>7} {latest:>7} {minimum:>7} {maximum:>7} {mean:>9.2f}")
+
+    def poll_with_dashboard(self, dashboard, ips, polling_rate, polling_amount=None, on_poll=None, on_change=None):
+        # Runs poll_devices on a background thread while the dashboard draws on this one, so drawing never
+        # delays a poll. Without a dashboard it just polls. Returns the poll_devices stats.
+        if dashboard is None:
+            return self.poll_devices(ips, polling_rate, polling_amount, on_poll, on_change)
+        stop = threading.Event()
+        result = {}
+        poller = threading.Thread(target=lambda: result.update(self.poll_devices(ips, polling_rate, polling_amount, on_poll, on_change, stop)))
+        poller.start()
+        try:
+            dashboard.run(stop, lambda: not poller.is_alive())
+        finally:
+            stop.set()
+            poller.join()
+        return result
+
+    @property
+    def exploit_index(self):
+        if self._exploit_index is None:
+            self._exploit_index = ExploitIndex(self.exploitdb_path or ExploitIndex.locate(), self.exploit_index_path).load()
+        return self._exploit_index
+
+    def searchsploit(self, vendor_name, product=None, revision=None):
+        try:
+            return self.exploit_index.match(vendor_name, product, revision)
+        except (OSError, RuntimeError) as e:
+            print(f"An error occurred while searching exploit-db: {e}")
             return None
 
+    def audit_devices(self, devices=None):
+        # Looks up exploits for every device, self.clients by default, in one pass over the index.
+        # Devices with the same identification share one lookup. Returns {device key: matches}, with
+        # devices that don't report a vendor left out.
+        results = {}
+        lookups = {}
+        for device in self.clients if devices is None else devices:
+            device_info = device.as_dict()['device_info'] or {}
+            vendor, product, revision = (device_info.get(object_id) for object_id in (0, 1, 2))
+            if not vendor:
+                continue
+            if (vendor, product, revision) not in lookups:
+                lookups[(vendor, product, revision)] = self.exploit_index.match(vendor, product, revision)
+            results[device.key] = lookups[(vendor, product, revision)]
+        return results
+
     def run(self):
         while True:
             print("\n")
@@ -241,7 +2493,7 @@ class ModbusScanner:
                 print("2. Read device memory map")
                 print("3. Write to device memory map")
                 print("4. Poll device and display results")
-                print("5. Searchsploit Device")
+                print("5. Search exploit-db for devices")
                 print("6. Exit")
             choice = input("Choose an option: ")
             if choice == '1':
@@ -273,9 +2525,19 @@ class ModbusScanner:
                     print("Invalid device. Please try again.")
                     continue
                 client_tuple = self.clients[selected]
-                client = ModbusTcpClient(client_tuple[0])
-                client.connect()
-                section_name = input("Enter section name (Coil, Holding Register): ")
+                section_name = input("Enter section name (Coil, Holding Register) or a recipe file: ")
+                if os.path.isfile(section_name):
+                    try:
+                        changes = self.load_write_recipe(section_name)
+                    except (OSError, ValueError) as e:
+                        print(f"Invalid recipe file: {e}")
+                        continue
+                    with self.pool.borrow(client_tuple.ip, self.modbus_port, client_tuple.unit) as client:
+                        failures = self.write_batch(client, changes, client_tuple[3])
+                    print(f"Wrote {len(changes) - len(failures)} of {len(changes)} values.")
+                    for failed_section, address, value, reason in failures:
+                        print(f"Failed to write {value} to {failed_section} at address {address}: {reason}")
+                    continue
                 try:
                     address = int(input("Enter address: "))
                     if section_name == "Coil":
@@ -289,7 +2551,8 @@ class ModbusScanner:
                 except ValueError:
                     print("Invalid address or value. Please try again.")
                     continue
-                success = self.write_modbus_memory(client, section_name, address, value)
+                with self.pool.borrow(client_tuple.ip, self.modbus_port, client_tuple.unit) as client:
+                    success = self.write_modbus_memory(client, section_name, address, value, client_tuple[3])
                 if success:
                     print(f"Successfully wrote to {section_name} at address {address}.")
                 else:
@@ -298,29 +2561,268 @@ class ModbusScanner:
                 self.poll_device()
             elif choice == '5' and self.clients:
                 self.print_clients()
-                selected = input("Select a device (or 'back' to go back): ")
+                selected = input("Select a device, 'all' for every device (or 'back' to go back): ")
                 if selected.lower() == 'back':
                     continue
-                selected = int(selected) - 1
-                if selected >= len(self.clients):
-                    print("Invalid device. Please try again.")
+                if selected.lower() == 'all':
+                    devices = self.clients
+                else:
+                    selected = int(selected) - 1
+                    if selected >= len(self.clients):
+                        print("Invalid device. Please try again.")
+                        continue
+                    devices = [self.clients[selected]]
+                try:
+                    results = self.audit_devices(devices)
+                except (OSError, RuntimeError) as e:
+                    print(f"An error occurred while searching exploit-db: {e}")
                     continue
-                vendor_name = self.clients[selected][1].get(0)  # Get the vendor name from the device info
-                if vendor_name:
-                    vendor_name = vendor_name.decode()  # Convert bytes to string
-                    searchsploit_results = self.searchsploit(vendor_name)
-                    if searchsploit_results:
-                        print(f"searchsploit results for {vendor_name}:\n{searchsploit_results}")
+                for device in devices:
+                    if device.key not in results:
+                        print(f"{device.key} does not have a vendor name.")
+                    elif not results[device.key]:
+                        print(f"No exploit-db results for {device.key}.")
                     else:
-                        print(f"No searchsploit results for {vendor_name}.")
-                else:
-                    print("This device does not have a vendor name.")
+                        print(f"exploit-db results for {device.key}:")
+                        for match in results[device.key]:
+                            flags = ' [product]' if match['product_match'] else ''
+                            flags += ' [revision]' if match['revision_match'] else ''
+                            print(f"  {match['id']:>6}  {match['title']}{flags}  ({match['path']})")
             elif choice == '6':
+                self.pool.close_all()
                 break
             else:
                 print("Invalid option. Please try again.")
 
 
+def scan_shard(network, settings, cache_entries):
+    # Runs in a worker process of ModbusScanner.sharded_scan. Returns the devices found in `network` and
+    # the refreshed cache entries for them; the parent owns the cache file.
+    scanner = ModbusScanner(network=network)
+    pool_settings = {name: settings.pop(name) for name in ('pipeline_depth', 'adaptive', 'policy_settings')}
+    for name, value in settings.items():
+        setattr(scanner, name, value)
+    scanner.pool = ConnectionPool(timeout=scanner.host_timeout, pipeline_depth=pool_settings['pipeline_depth'], metrics=scanner.metrics)
+    scanner.pool.adaptive = pool_settings['adaptive']
+    scanner.pool.policy_settings = pool_settings['policy_settings']
+    scanner.cache_path = None
+    scanner.cache = cache_entries
+    scanner.modbus_scan()
+    scanner.pool.close_all()
+    return scanner.clients, scanner.cache, scanner.metrics.snapshot()
+
+
+def parse_change(change):
+    # "holding_registers:40=1200" -> ('holding_registers', 40, 1200)
+    try:
+        target, value = change.split('=')
+        section_name, address = target.split(':')
+        return section_name, int(address), int(value)
+    except ValueError:
+        raise ValueError(f"{change!r} isn't section:address=value")
+
+
+def parse_unit_range(units):
+    # "1-8,16,247" -> [1, 2, ..., 8, 16, 247]
+    unit_ids = []
+    for part in units.split(','):
+        first, _, last = part.partition('-')
+        unit_ids.extend(range(int(first), int(last or first) + 1))
+    if any(unit < 0 or unit > 255 for unit in unit_ids):
+        raise argparse.ArgumentTypeError(f"unit IDs must be between 0 and 255: {units}")
+    return unit_ids
+
+
+def parse_polling_rate(rate):
+    try:
+        seconds = float(rate)
+    except ValueError:
+        seconds = None
+    if seconds is None or not seconds > 0:
+        raise argparse.ArgumentTypeError(f"polling rate must be a number of seconds above 0: {rate}")
+    return seconds
+
+
+def parse_resolution(resolution):
+    try:
+        addresses = int(resolution)
+    except ValueError:
+        addresses = 0
+    if addresses < 1:
+        raise argparse.ArgumentTypeError(f"resolution must be a whole number of addresses above 0: {resolution}")
+    return addresses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Modbus TCP scanner. Run without a command for the interactive menu.")
+    parser.add_argument('--network', action='append', help="CIDR, address or range (10.0.0.10-10.0.0.50) to scan instead of every "
+                        "local interface subnet; repeat or comma separate for several")
+    parser.add_argument('--port', type=int, default=502, help="Modbus TCP port")
+    parser.add_argument('--metrics', help="Write request metrics here on exit, Prometheus text for a .prom file, JSON otherwise")
+    parser.add_argument('--exploitdb', help="exploit-db's files_exploits.csv, if it isn't in the usual install locations")
+    subparsers = parser.add_subparsers(dest='command')
+    scan_parser = subparsers.add_parser('scan', help="Enumerate the network and print each device as a JSON line")
+    scan_parser.add_argument('--discover', action='store_true', help="Map the full address range of each device")
+    scan_parser.add_argument('--resolution', type=parse_resolution, default=1024, help="With --discover, addresses between samples "
+                             "of invalid space; lower finds smaller isolated ranges but costs more requests")
+    scan_parser.add_argument('--processes', type=int, default=1, help="Worker processes to shard the scan across")
+    scan_parser.add_argument('--units', type=parse_unit_range, help="Unit IDs to probe behind each host, e.g. 1-247, to inventory gateways")
+    scan_parser.add_argument('--gateway-in-flight', type=int, default=2, help="Requests in flight to one gateway while probing its units")
+    scan_parser.add_argument('--export', help="Stream the device inventory to a .csv, .jsonl or .parquet file as devices are found")
+    scan_parser.add_argument('--export-memory', help="Stream every device's memory map to a .csv, .jsonl or .parquet file, one row per address")
+    scan_parser.add_argument('--audit', action='store_true', help="Add the exploit-db entries matching each device's identification")
+    read_parser = subparsers.add_parser('read', help="Read one device and print it as JSON")
+    read_parser.add_argument('host')
+    read_parser.add_argument('--unit', type=int, help="Unit ID behind a gateway")
+    read_parser.add_argument('--discover', action='store_true', help="Map the full address range of the device")
+    read_parser.add_argument('--resolution', type=parse_resolution, default=1024, help="With --discover, addresses between samples "
+                             "of invalid space; lower finds smaller isolated ranges but costs more requests")
+    poll_parser = subparsers.add_parser('poll', help="Poll devices and print each poll as a JSON line")
+    poll_parser.add_argument('hosts', nargs='+', help="Devices to poll, as ip or ip/unit")
+    poll_parser.add_argument('--unit', type=int, help="Unit ID behind a gateway, for hosts given without one")
+    poll_parser.add_argument('--rate', type=parse_polling_rate, default=1.0, help="Seconds between polls")
+    poll_parser.add_argument('--count', type=int, default=10, help="Polls to take, 0 to poll until interrupted")
+    poll_parser.add_argument('--capture-dir', help="Also write the polls to a capture file in this directory")
+    poll_parser.add_argument('--export', help="Stream the polls to a .csv, .jsonl or .parquet file, one row per value, instead of printing them")
+    poll_parser.add_argument('--dashboard', action='store_true', help="Show the polls in a live terminal view instead of printing them")
+    poll_parser.add_argument('--changes-only', action='store_true', help="Print or export only the values that changed since the "
+                             "last poll, as old and new value events, instead of every sample")
+    write_parser = subparsers.add_parser('write', help="Write values to one device")
+    write_parser.add_argument('host')
+    write_parser.add_argument('--unit', type=int, help="Unit ID behind a gateway")
+    write_parser.add_argument('changes', nargs='*', help="section:address=value, e.g. holding_registers:40=1200")
+    write_parser.add_argument('--recipe', help="CSV file of section,address,value rows")
+    args = parser.parse_args(argv)
+
+    scanner = ModbusScanner(network=args.network)
+    scanner.modbus_port = args.port
+    scanner.scan_ports = [args.port]
+    scanner.exploitdb_path = args.exploitdb
+    if args.command is None:
+        try:
+            scanner.run()
+        finally:
+            if args.metrics:
+                scanner.metrics.dump(args.metrics)
+        return 0
+
+    try:
+        if args.command == 'scan':
+            scanner.discover_memory = args.discover
+            scanner.discover_resolution = args.resolution
+            scanner.scan_processes = args.processes
+            scanner.unit_ids = args.units
+            scanner.gateway_in_flight = args.gateway_in_flight
+            exporters = []
+            try:
+                if args.export:
+                    exporters.append((open_exporter(args.export, INVENTORY_FIELDS), inventory_rows))
+                if args.export_memory:
+                    exporters.append((open_exporter(args.export_memory, MEMORY_FIELDS), memory_rows))
+            except (OSError, RuntimeError, ValueError) as e:
+                for exporter, _ in exporters:
+                    exporter.close()
+                logger.error(f"Can't export: {e}")
+                return 2
+
+            def export(device):
+                for exporter, rows in exporters:
+                    exporter.write(rows(device))
+
+            scanner.on_device = export
+            try:
+                scanner.modbus_scan()
+            finally:
+                for exporter, _ in exporters:
+                    exporter.close()
+            exploits = scanner.audit_devices() if args.audit else {}
+            for device in scanner.clients:
+                device_dict = device.as_dict()
+                if args.audit:
+                    device_dict['exploits'] = exploits.get(device.key, [])
+                print(json.dumps(device_dict))
+        elif args.command == 'read':
+            scanner.discover_memory = args.discover
+            scanner.discover_resolution = args.resolution
+            device = scanner.scan_host(args.host, args.unit)
+            print(json.dumps(device.as_dict()))
+            return 0 if device.role is not None else 1
+        elif args.command == 'poll':
+            try:
+                exporter = open_exporter(args.export, CHANGE_FIELDS if args.changes_only else SAMPLE_FIELDS) if args.export else None
+            except (OSError, RuntimeError, ValueError) as e:
+                logger.error(f"Can't export: {e}")
+                return 2
+            for host in args.hosts:
+                ip, unit = parse_device_key(host)
+                device = scanner.scan_host(ip, args.unit if unit is None else unit)
+                if device.memory_map is None:
+                    logger.error(f"{device.key} doesn't have a memory map")
+                    continue
+                scanner.clients.append(device)
+            if not scanner.clients:
+                if exporter is not None:
+                    exporter.close()
+                return 1
+            captures = {}
+            if args.capture_dir:
+                for device in scanner.clients:
+                    captures[device.key] = PollCapture(os.path.join(args.capture_dir, f"{device.key.replace('/', '-')}-{time.strftime('%Y%m%d-%H%M%S')}.cap"), device.memory_map)
+
+            dashboard = PollDashboard({device.key: device.memory_map for device in scanner.clients}, scanner.dashboard_fps) if args.dashboard else None
+
+            def report(ip, poll_num, memory_map):
+                timestamp = time.time()
+                if ip in captures:
+                    captures[ip].append(memory_map, timestamp)
+                if dashboard is not None:
+                    dashboard.update(ip, poll_num, memory_map, timestamp)
+                if args.changes_only:
+                    return
+                if exporter is not None:
+                    exporter.write(sample_rows(ip, poll_num + 1, timestamp, memory_map))
+                elif dashboard is None:
+                    memory_map = {section: dict(values.items()) for section, values in memory_map.items()}
+                    print(json.dumps({'ip': ip, 'poll': poll_num + 1, 'timestamp': timestamp, 'memory_map': memory_map}))
+
+            def report_changes(ip, events):
+                if dashboard is not None:
+                    dashboard.mark_changes(ip, events)
+                if not args.changes_only:
+                    return
+                if exporter is not None:
+                    exporter.write(change_rows(ip, events))
+                elif dashboard is None:
+                    for section, address, old, new, timestamp in events:
+                        print(json.dumps({'ip': ip, 'timestamp': timestamp, 'section': section, 'address': address, 'old': old, 'new': new}))
+
+            try:
+                scanner.poll_with_dashboard(dashboard, [device.key for device in scanner.clients], args.rate, args.count or None,
+                                            report, report_changes)
+            finally:
+                for capture in captures.values():
+                    capture.close()
+                if exporter is not None:
+                    exporter.close()
+        elif args.command == 'write':
+            try:
+                changes = [parse_change(change) for change in args.changes]
+                if args.recipe:
+                    changes.extend(scanner.load_write_recipe(args.recipe))
+            except (OSError, ValueError) as e:
+                logger.error(f"Invalid change: {e}")
+                return 2
+            with scanner.pool.borrow(args.host, scanner.modbus_port, args.unit) as client:
+                failures = scanner.write_batch(client, changes)
+            for section_name, address, value, reason in failures:
+                logger.error(f"Failed to write {value} to {section_name} at address {address}: {reason}")
+            return 1 if failures else 0
+    finally:
+        scanner.pool.close_all()
+        if args.metrics:
+            scanner.metrics.dump(args.metrics)
+    return 0
+
+
 if __name__ == '__main__':
-    scanner = ModbusScanner()
-    scanner.run()
+    sys.exit(main())
@@ -1,47 +1,376 @@
 # Import required libraries
+import os
+import sys
+import json
+import time
 import random
+import asyncio
 import logging
+import argparse
+import resource
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
-from pymodbus.server.async_io import StartTcpServer
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.mei_message import ReadDeviceInformationResponse
+from pymodbus.server.async_io import StartAsyncTcpServer, ModbusTcpServer
 
 # Enable logging (makes it easier to debug if something goes wrong)
 logging.basicConfig()
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
-# Define your device identification
-device_identification = ModbusDeviceIdentification()
-device_identification.VendorName  = 'ModbusTagServer'
-device_identification.ProductCode = 'pymodbus'
-device_identification.VendorUrl   = 'Pymodbus.com'
-device_identification.ProductName = 'pymodbus Server'
-device_identification.ModelName   = 'pymodbus Server'
-device_identification.MajorMinorRevision = '1.0'
+DEFAULT_IDENTITY = {
+    'VendorName': 'ModbusTagServer',
+    'ProductCode': 'pymodbus',
+    'VendorUrl': 'Pymodbus.com',
+    'ProductName': 'pymodbus Server',
+    'ModelName': 'pymodbus Server',
+    'MajorMinorRevision': '1.0'
+}
 
-# Define the Modbus registers
-coils = ModbusSequentialDataBlock(0, [False] * 5)
-discrete_inputs = ModbusSequentialDataBlock(1, [False] * 6)
-holding_registers = ModbusSequentialDataBlock(1, [1234])
-input_registers = ModbusSequentialDataBlock(1, [8888])
+# Device identification object IDs for the identity field names
+IDENTITY_OBJECTS = {
+    'VendorName': 0x00,
+    'ProductCode': 0x01,
+    'MajorMinorRevision': 0x02,
+    'VendorUrl': 0x03,
+    'ProductName': 0x04,
+    'ModelName': 0x05,
+    'UserApplicationName': 0x06
+}
 
-temperature_values = [random.randint(4, 15) for _ in range(7)]
-holding_registers.setValues(1, temperature_values)
-print("temperature_values:", temperature_values)
+TABLE_FUNCTION_CODES = {'coils': 1, 'discrete_inputs': 2, 'holding_registers': 3, 'input_registers': 4}
 
 
-# Define the Modbus slave context
-slave_context = ModbusSlaveContext(
-    di=discrete_inputs,
-    co=coils,
-    hr=holding_registers,
-    ir=input_registers
-)
+class ConfigError(ValueError):
+    # A simulator config that can't be run as written
+    pass
 
-# Define the Modbus server context
-server_context = ModbusServerContext(slaves=slave_context, single=True)
 
-# Start the Modbus TCP server
-StartTcpServer(context=server_context, address=("localhost", 502))
+class SparseDataBlock(BaseModbusDataBlock):
+    # Holds only the configured address ranges, each backed by one numpy array, so a large or sparse
+    # map costs two bytes per register (one per bit) rather than a Python object per address.
+    # Ranges are (start, count) or (start, count, initial value); overlapping or adjacent ranges merge.
+    def __init__(self, ranges, bits=False):
+        self.default_value = False if bits else 0
+        dtype = np.bool_ if bits else np.uint16
+        self.segments = []
+        for start, count, *initial in sorted(tuple(r) for r in ranges):
+            values = np.full(count, initial[0] if initial else self.default_value, dtype=dtype)
+            if self.segments and self.segments[-1][0] + len(self.segments[-1][1]) >= start:
+                previous_start, previous = self.segments[-1]
+                merged = np.zeros(max(previous_start + len(previous), start + count) - previous_start, dtype=dtype)
+                merged[:len(previous)] = previous
+                merged[start - previous_start:start - previous_start + count] = values
+                self.segments[-1] = (previous_start, merged)
+            else:
+                self.segments.append((start, values))
+        self.starts = [start for start, _ in self.segments]
+        self.address = self.starts[0] if self.starts else 0
 
+    def segment(self, address, count):
+        i = bisect_right(self.starts, address) - 1
+        if i < 0:
+            return None
+        start, values = self.segments[i]
+        if address + count > start + len(values):
+            return None
+        return address - start, values
 
+    def validate(self, address, count=1):
+        return count > 0 and self.segment(address, count) is not None
+
+    def getValues(self, address, count=1):
+        offset, values = self.segment(address, count)
+        return values[offset:offset + count].tolist()
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, tuple, np.ndarray)):
+            values = [values]
+        offset, block = self.segment(address, len(values))
+        block[offset:offset + len(values)] = values
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for _, values in self.segments)
+
+    def __str__(self):
+        return f"SparseDataBlock({len(self.segments)} ranges, {sum(len(values) for _, values in self.segments)} addresses)"
+
+    def __iter__(self):
+        for start, values in self.segments:
+            yield from enumerate(values.tolist(), start)
+
+
+class QuietSlaveContext(ModbusSlaveContext):
+    # ModbusSlaveContext formats a debug line on every datastore access even when DEBUG is off;
+    # this only does so when it will actually be logged
+    def validate(self, fc_as_hex, address, count=1):
+        if not self.zero_mode:
+            address = address + 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"validate: fc-[{fc_as_hex}] address-{address}: count-{count}")
+        return self.store[self.decode(fc_as_hex)].validate(address, count)
+
+    def getValues(self, fc_as_hex, address, count=1):
+        if not self.zero_mode:
+            address = address + 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"getValues: fc-[{fc_as_hex}] address-{address}: count-{count}")
+        return self.store[self.decode(fc_as_hex)].getValues(address, count)
+
+    def setValues(self, fc_as_hex, address, values):
+        if not self.zero_mode:
+            address = address + 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"setValues[{fc_as_hex}] address-{address}: count-{len(values)}")
+        self.store[self.decode(fc_as_hex)].setValues(address, values)
+
+
+class Signal:
+    # One generated pattern over a run of addresses, evaluated for every device that shares it as a
+    # single (devices, count) array. Each device gets its own phase so a fleet doesn't move in lockstep.
+    #   ramp:   rises from min to max every `period` seconds
+    #   noise:  normal around `mean` with `std`
+    #   step:   holds each of `levels` for `period` seconds
+    #   replay: plays a PLCFramework poll capture file back at its recorded pace
+    def __init__(self, spec, devices, rng):
+        self.spec = spec
+        self.kind = spec.get('type')
+        self.table = spec.get('table')
+        if self.table not in TABLE_FUNCTION_CODES:
+            raise ConfigError(f"Unknown signal table: {self.table}")
+        self.function_code = TABLE_FUNCTION_CODES[self.table]
+        self.start = spec.get('start', 0)
+        self.count = spec.get('count', 1)
+        self.bits = self.table in ('coils', 'discrete_inputs')
+        self.low = spec.get('min', 0)
+        self.high = spec.get('max', 1 if self.bits else 65535)
+        self.phase = rng.uniform(0, 1, (devices, 1))
+        if self.kind == 'replay':
+            self.load_capture(spec['capture'], spec.get('section', self.table))
+        elif self.kind not in ('ramp', 'noise', 'step'):
+            raise ConfigError(f"Unknown signal type: {self.kind}")
+
+    def load_capture(self, path, section):
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from PLCFramework import open_capture, unpack_bits
+        header, records = open_capture(path)
+        if len(records) == 0:
+            raise ConfigError(f"{path} has no polls to replay")
+        values = records[section]
+        if section in ('coils', 'discrete_inputs'):
+            values = unpack_bits(header, section, values)
+        # Addresses missing from the capture replay as zero
+        columns = {address: i for i, address in enumerate(header['sections'][section])}
+        self.frames = np.zeros((len(records), self.count))
+        for offset in range(self.count):
+            if self.start + offset in columns:
+                self.frames[:, offset] = values[:, columns[self.start + offset]]
+        self.times = records['timestamp'] - records['timestamp'][0]
+        self.duration = max(self.times[-1], 1e-9)
+
+    def generate(self, t, rng):
+        devices = len(self.phase)
+        if self.kind == 'ramp':
+            values = self.low + (self.high - self.low) * ((t / self.spec.get('period', 60) + self.phase) % 1)
+        elif self.kind == 'noise':
+            values = rng.normal(self.spec.get('mean', (self.low + self.high) / 2), self.spec.get('std', 1), (devices, self.count))
+        elif self.kind == 'step':
+            levels = np.asarray(self.spec['levels'])
+            values = levels[(t / self.spec.get('period', 10) + self.phase * len(levels)).astype(int) % len(levels)]
+        else:
+            rows = np.searchsorted(self.times, (t + self.phase[:, 0] * self.duration) % self.duration)
+            values = self.frames[np.minimum(rows, len(self.frames) - 1)]
+        values = np.clip(np.rint(np.broadcast_to(values, (devices, self.count))), self.low, self.high)
+        return values.astype(bool if self.bits else np.uint16).tolist()
+
+
+class SignalEngine:
+    # Regenerates every signal-driven table at a fixed rate. Values are computed on a worker thread
+    # and only copied into the datastores on the event loop, so request handling never waits on them.
+    def __init__(self, rate=1.0, seed=None):
+        self.rate = rate
+        self.rng = np.random.default_rng(seed)
+        self.signals = []  # (Signal, slave contexts)
+
+    def add(self, spec, slaves):
+        # A signal has to fit in the datastores it drives, or the first update would fail on the event loop
+        signal = Signal(spec, len(slaves), self.rng)
+        if not all(slave.validate(signal.function_code, signal.start, signal.count) for slave in slaves):
+            raise ConfigError(f"{signal.kind} signal on {signal.table} {signal.start}-{signal.start + signal.count - 1} "
+                              f"is outside the configured ranges")
+        self.signals.append((signal, slaves))
+
+    def generate(self, t):
+        return [signal.generate(t, self.rng) for signal, _ in self.signals]
+
+    async def run(self):
+        if not self.signals or self.rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        next_update = loop.time()
+        while True:
+            frames = await loop.run_in_executor(executor, self.generate, time.time())
+            for (signal, slaves), rows in zip(self.signals, frames):
+                for slave, row in zip(slaves, rows):
+                    slave.setValues(signal.function_code, signal.start, row)
+            next_update += 1 / self.rate
+            delay = next_update - loop.time()
+            if delay < 0:  # Fell behind, don't try to catch up with a burst of updates
+                next_update = loop.time()
+            await asyncio.sleep(max(0, delay))
+
+
+def make_identity(fields):
+    identity = ModbusDeviceIdentification()
+    for name, value in {**DEFAULT_IDENTITY, **fields}.items():
+        setattr(identity, name, value)
+    return identity
+
+
+def identity_manipulator(fields):
+    # pymodbus answers device identification from one process-wide control block (and
+    # ModbusDeviceIdentification shares its storage between instances), so each simulated PLC swaps
+    # its own identity into the response before it is encoded
+    objects = {IDENTITY_OBJECTS[name]: value for name, value in {**DEFAULT_IDENTITY, **fields}.items()}
+
+    def manipulate(response):
+        if isinstance(response, ReadDeviceInformationResponse):
+            response.information = {object_id: objects.get(object_id, '') for object_id in response.information}
+        return response, False
+    return manipulate
+
+
+def build_slave_context(layout):
+    # zero_mode keeps the configured addresses identical to the addresses on the wire
+    return QuietSlaveContext(
+        di=SparseDataBlock(layout.get('discrete_inputs', []), bits=True),
+        co=SparseDataBlock(layout.get('coils', []), bits=True),
+        hr=SparseDataBlock(layout.get('holding_registers', [])),
+        ir=SparseDataBlock(layout.get('input_registers', [])),
+        zero_mode=True
+    )
+
+
+def raise_file_limit():
+    # Every simulated PLC holds a listening socket plus one per client connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run_simulator(config, rate=1.0):
+    # Config file (JSON):
+    #   {"host": "127.0.0.1", "rate": 2,
+    #    "layouts": {"pump": {"coils": [[0, 16]], "holding_registers": [[0, 100], [1000, 20, 1234]],
+    #                         "signals": [{"table": "holding_registers", "start": 0, "count": 10,
+    #                                      "type": "ramp", "min": 0, "max": 1000, "period": 30}]}},
+    #    "devices": [{"port": 5020, "count": 200, "units": [1], "layout": "pump",
+    #                 "identity": {"VendorName": "Acme"}}]}
+    # A device entry with a count is repeated on that many consecutive ports. Each unit ID on a port
+    # gets its own copy of the layout's memory; a port with a single unit answers on any unit ID, as
+    # standalone PLCs usually do, while a multi-unit gateway only answers its configured units.
+    # Signals listed in a layout drive that layout's tables on every device using it, updated `rate`
+    # times a second.
+    raise_file_limit()
+    host = config.get('host', '127.0.0.1')
+    layouts = config['layouts']
+    identity = make_identity({})
+    servers = []
+    backing_bytes = 0
+    plcs = 0
+    layout_slaves = {name: [] for name in layouts}
+    for device in config['devices']:
+        manipulator = identity_manipulator(device.get('identity', {}))
+        units = device.get('units', [1])
+        for port in range(device['port'], device['port'] + device.get('count', 1)):
+            slaves = {unit: build_slave_context(layouts[device['layout']]) for unit in units}
+            layout_slaves[device['layout']].extend(slaves.values())
+            backing_bytes += sum(block.nbytes for slave in slaves.values() for block in slave.store.values())
+            if len(units) == 1:
+                context = ModbusServerContext(slaves=slaves[units[0]], single=True)
+            else:
+                context = ModbusServerContext(slaves=slaves, single=False)
+            servers.append(ModbusTcpServer(
+                context,
+                identity=identity,
+                address=(device.get('host', host), port),
+                allow_reuse_address=True,
+                response_manipulator=manipulator
+            ))
+            plcs += len(units)
+    engine = SignalEngine(config.get('rate', rate), config.get('seed'))
+    for name, layout in layouts.items():
+        for spec in layout.get('signals', []):
+            if layout_slaves[name]:
+                try:
+                    engine.add(spec, layout_slaves[name])
+                except ConfigError as e:
+                    raise ConfigError(f"layout {name}: {e}") from e
+    log.info(f"Simulating {plcs} PLCs on {len(servers)} ports ({backing_bytes / 1024:.1f} KiB of register memory)")
+    await asyncio.gather(engine.run(), *(server.serve_forever() for server in servers))
+
+
+async def run_tag_server(rate=1.0):
+    # Define your device identification
+    device_identification = make_identity({})
+
+    # Define the Modbus registers
+    coils = ModbusSequentialDataBlock(0, [False] * 5)
+    discrete_inputs = ModbusSequentialDataBlock(1, [False] * 6)
+    holding_registers = ModbusSequentialDataBlock(1, [1234])
+    input_registers = ModbusSequentialDataBlock(1, [8888])
+
+    temperature_values = [random.randint(4, 15) for _ in range(7)]
+    holding_registers.setValues(1, temperature_values)
+    print("temperature_values:", temperature_values)
+
+    # Define the Modbus slave context
+    slave_context = QuietSlaveContext(
+        di=discrete_inputs,
+        co=coils,
+        hr=holding_registers,
+        ir=input_registers
+    )
+
+    # Define the Modbus server context
+    server_context = ModbusServerContext(slaves=slave_context, single=True)
+
+    # Keep the temperatures moving while the server runs
+    engine = SignalEngine(rate)
+    engine.add({'table': 'holding_registers', 'start': 0, 'count': 7, 'type': 'noise', 'mean': 9.5, 'std': 2, 'min': 4, 'max': 15}, [slave_context])
+
+    # Start the Modbus TCP server
+    await asyncio.gather(
+        engine.run(),
+        StartAsyncTcpServer(context=server_context, identity=device_identification, address=("localhost", 502))
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Modbus TCP tag server and multi-PLC simulator")
+    parser.add_argument('--simulate', metavar='CONFIG', help="Host the virtual PLC fleet described by a JSON config file")
+    parser.add_argument('--rate', type=float, default=1.0, help="Signal updates per second (0 to keep values static)")
+    parser.add_argument('--quiet', action='store_true', help="Only log warnings, for high request rates")
+    args = parser.parse_args(argv)
+    if args.quiet:
+        log.setLevel(logging.WARNING)
+    if args.simulate:
+        with open(args.simulate) as f:
+            config = json.load(f)
+        try:
+            asyncio.run(run_simulator(config, args.rate))
+        except ConfigError as e:
+            log.error(f"Invalid simulator config {args.simulate}: {e}")
+            return 1
+    else:
+        asyncio.run(run_tag_server(args.rate))
+
+
+if __name__ == '__main__':
+    sys.exit(main())